@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+import mrcl_lexer
+import mrcl_parser
+import mrcl_codegen
+import mrcl_peephole
+import mrcl_asm
+from mrcl_vm import Memory, Vm
+from mrcl_jit import JitVm
+
+from lib.common import file_read
+
+# Times each stage (tokenize, parse, codegen, assemble, VM execution)
+# separately on generated programs and on the game of life.
+#
+#   python3 bench/bench.py [--runs N] [--scale N] [--out FILE]
+#
+# Results are written as JSON so that runs of different versions and
+# engines can be compared.
+
+STACK_SIZE = 50
+ENGINES = {
+    "interp": Vm,
+    "jit": JitVm,
+}
+
+# --------------------------------
+# programs
+
+# a loop evaluating one deeply nested expression
+def gen_deep_expr(scale):
+    depth = 20 * scale
+    expr = "x"
+    for i in range(depth):
+        if i % 2 == 0:
+            expr = f"({expr} + {i})"
+        else:
+            expr = f"({expr} * 1)"
+
+    return f"""
+func main() {{
+  var x = 0;
+  var y;
+  var i = 0;
+  while (i != 100) {{
+    set y = {expr};
+    set i = i + 1;
+  }}
+  call set_vram(0, y);
+}}
+"""
+
+# many small functions called in sequence
+def gen_many_funcs(scale):
+    num_funcs = 100 * scale
+    parts = []
+    for i in range(num_funcs):
+        parts.append(f"""
+func f_{i}(a, b) {{
+  var c = a + {i};
+  case
+    when (c == b) {{ set c = c + 1; }}
+  return c;
+}}
+""")
+
+    calls = "\n".join(
+        f"  call_set x = f_{i}(x, {i});" for i in range(num_funcs)
+    )
+    parts.append(f"""
+func main() {{
+  var x = 0;
+{calls}
+  call set_vram(0, x);
+}}
+""")
+    return "".join(parts)
+
+# nested loops with arithmetic and VRAM access
+def gen_long_loop(scale):
+    return f"""
+func main() {{
+  var i = 0;
+  var j;
+  var sum = 0;
+  var v;
+  while (i != {100 * scale}) {{
+    set j = 0;
+    while (j != 10) {{
+      set sum = sum + (i * j) + 1;
+      call set_vram(j, sum);
+      call_set v = get_vram(j);
+      set j = j + 1;
+    }}
+    set i = i + 1;
+  }}
+}}
+"""
+
+def load_programs(scale):
+    programs = {
+        "deep_expr": gen_deep_expr(scale),
+        "many_funcs": gen_many_funcs(scale),
+        "long_loop": gen_long_loop(scale),
+        "life": file_read(os.path.join(BENCH_DIR, "life.mrcl")),
+    }
+
+    path = os.path.join(PROJECT_DIR, "test_common", "compile", "27.mrcl")
+    if os.path.exists(path):
+        programs["game_of_life_27"] = file_read(path)
+
+    return programs
+
+# --------------------------------
+# measurement
+
+def summarize(times):
+    return {
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) >= 2 else 0.0,
+        "min": min(times),
+        "max": max(times),
+        "runs": len(times),
+    }
+
+def measure(fn, runs):
+    times = []
+    result = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = summarize(times)
+    stats["peak_memory"] = peak
+    return (stats, result)
+
+def run_vm(engine, insns, max_steps):
+    vm = ENGINES[engine](Memory(STACK_SIZE), STACK_SIZE)
+    vm.load_program(insns)
+    return vm.run(max_steps)
+
+def bench_program(src, runs, max_steps, peephole, inline_vram):
+    stages = {}
+
+    stats, tokens = measure(lambda: mrcl_lexer.tokenize(src), runs)
+    stats["tokens_per_sec"] = len(tokens) / stats["mean"]
+    stages["tokenize"] = stats
+
+    stats, tree = measure(lambda: mrcl_parser.parse(tokens), runs)
+    stats["tokens_per_sec"] = len(tokens) / stats["mean"]
+    stages["parse"] = stats
+
+    stats, asm_insns = measure(
+        lambda: mrcl_codegen.codegen(tree, reg_b_leaf=True, inline_vram=inline_vram),
+        runs
+    )
+    stages["codegen"] = stats
+
+    if peephole:
+        stats, (asm_insns, _) = measure(lambda: mrcl_peephole.optimize(asm_insns), runs)
+        stages["peephole"] = stats
+
+    stats, insns = measure(lambda: mrcl_asm.assemble(asm_insns), runs)
+    stats["insns"] = len(insns)
+    stages["assemble"] = stats
+
+    for engine in ENGINES:
+        stats, state = measure(lambda: run_vm(engine, insns, max_steps), runs)
+        stats["steps"] = state["step"]
+        stats["exited"] = state["exited"]
+        stats["insns_per_sec"] = state["step"] / stats["mean"]
+        stages[f"vm_{engine}"] = stats
+
+    return stages
+
+# --------------------------------
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(name, stages):
+    print(f"==== {name}")
+    for stage, stats in stages.items():
+        rate = ""
+        if "tokens_per_sec" in stats:
+            rate = f"{stats['tokens_per_sec']:12.0f} tokens/sec"
+        elif "insns_per_sec" in stats:
+            rate = f"{stats['insns_per_sec']:12.0f} insns/sec"
+
+        print(
+            f"  {stage:<10} {stats['mean'] * 1000:10.2f} ms"
+            f" +- {stats['stdev'] * 1000:8.2f}"
+            f"  peak {stats['peak_memory'] / 1024:9.1f} KiB  {rate}"
+        )
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=int, default=1,
+        help="size factor of the generated programs"
+    )
+    parser.add_argument(
+        "--max-steps", type=int, default=2_000_000,
+        help="step budget for each VM run"
+    )
+    parser.add_argument("--peephole", action="store_true")
+    parser.add_argument("--inline-vram", action="store_true")
+    parser.add_argument(
+        "--only", action="append",
+        help="run only the given program (can be repeated)"
+    )
+    parser.add_argument("--out", metavar="FILE", help="write results as JSON")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": {
+            "runs": args.runs,
+            "scale": args.scale,
+            "max_steps": args.max_steps,
+            "peephole": args.peephole,
+            "inline_vram": args.inline_vram,
+        },
+        "programs": {},
+    }
+
+    for name, src in load_programs(args.scale).items():
+        if args.only != None and name not in args.only:
+            continue
+
+        stages = bench_program(
+            src, args.runs, args.max_steps, args.peephole, args.inline_vram
+        )
+        results["programs"][name] = stages
+        print_results(name, stages)
+
+    if args.out != None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
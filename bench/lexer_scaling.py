@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mrcl_lexer import tokenize
+
+# Tokenizes generated sources of increasing size.
+# Time per MB should stay roughly constant (linear scaling).
+#
+#   python3 bench/lexer_scaling.py [max_mb]
+
+FUNC_TEMPLATE = """\
+// function {i}
+func f_{i}(a, b) {{
+  var x = a * {i} + -1;
+  var y;
+  set y = (x + b) * 2;
+  while (y != 0) {{
+    set y = y + -1;
+  }}
+  case
+    when (x == {i}) {{ call_set y = f_{i}(x, b); }}
+  _cmt("f {i}");
+  return x + y;
+}}
+"""
+
+def generate_src(size):
+    parts = []
+    total = 0
+    i = 0
+    while total < size:
+        part = FUNC_TEMPLATE.format(i=i)
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return "".join(parts)
+
+def main():
+    max_mb = int(sys.argv[1]) if len(sys.argv) >= 2 else 8
+
+    mb = 1
+    while mb <= max_mb:
+        src = generate_src(mb * 1024 * 1024)
+
+        t0 = time.perf_counter()
+        tokens = tokenize(src)
+        sec = time.perf_counter() - t0
+
+        print(
+            f"{mb:>3} MB  {len(tokens):>9} tokens  {sec:7.3f} sec"
+            f"  {sec / mb:6.3f} sec/MB  {len(tokens) / sec:11.0f} tokens/sec"
+        )
+        mb *= 2
+
+if __name__ == "__main__":
+    main()
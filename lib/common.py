@@ -24,6 +24,8 @@ def file_read(path):
         return f.read()
 
 class Token:
+    __slots__ = ("kind", "value", "lineno")
+
     def __init__(self, kind, value, lineno):
         self.kind = kind
         self.value = value
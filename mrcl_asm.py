@@ -1,62 +1,205 @@
+import argparse
 import json
 import re
+import sys
 
-from lib.common import read_stdin_all, p_e
+import mrcl_exe
+
+from lib.common import p_e
+
+RE_INT = re.compile(r"^-?\d+$")
+
+JUMP_OPCODES = frozenset(["jmp", "je", "call"])
+
+def split_line(line):
+    stripped = line.strip()
+    if stripped == "" or stripped.startswith("#"):
+        return None
+    return stripped.split()
 
 def parse(src):
     alines = []
     for line in src.split("\n"):
-        stripped = line.strip()
-        if stripped != "":
-            if not stripped.startswith("#"):
-                alines.append(stripped.split())
+        aline = split_line(line)
+        if aline != None:
+            alines.append(aline)
     return alines
 
-def create_label_addr_map(alines):
-    map = {}
-    addr = 1
+# blank lines and comments in the codegen instruction buffer
+def is_insn(aline):
+    return len(aline) > 0 and not aline[0].startswith("#")
 
-    for aline in alines:
-        head = aline[0]
-        rest = aline[1:]
-        if head == "label":
-            name = rest[0]
-            map[name] = addr
-        addr += 1
+# lines: assembly text lines, or instructions already split into fields
+# (e.g. the codegen instruction buffer)
+# => [(lineno, aline), ...]
+def to_numbered_alines(lines):
+    numbered = []
+    for i, line in enumerate(lines):
+        if type(line) == str:
+            aline = split_line(line)
+        else:
+            aline = line if is_insn(line) else None
+
+        if aline != None:
+            numbered.append((i + 1, aline))
+    return numbered
+
+# The address of a label is the address of the instruction that follows
+# the label instruction.
+def create_symbol_table(numbered_alines):
+    symbols = {}
+    errors = []
+
+    for addr, (lineno, aline) in enumerate(numbered_alines):
+        if aline[0] == "label":
+            name = aline[1]
+            if name in symbols:
+                errors.append((lineno, f"duplicate label ({name})"))
+            else:
+                symbols[name] = addr + 1
 
-    return map
+    return (symbols, errors)
 
 def to_machine_code_operand(arg):
-    if re.match(r"^\[(.+)\]$", arg):
-        m = re.match(r"^\[(.+)\]$", arg)
-        return "mem:" + m.group(1)
-    elif re.match(r"^-?\d+$", arg):
+    if type(arg) == int:
+        return arg
+    elif len(arg) > 2 and arg[0] == "[" and arg[-1] == "]":
+        return "mem:" + arg[1:-1]
+    elif RE_INT.match(arg):
         return int(arg)
     else:
         return arg
 
-# --------------------------------
+# => (insns, symbol table)
+def assemble_with_symbols(lines):
+    numbered_alines = to_numbered_alines(lines)
+    symbols, errors = create_symbol_table(numbered_alines)
+
+    insns = []
+    for lineno, aline in numbered_alines:
+        head = aline[0]
+        rest = aline[1:]
+
+        insn = [head]
+        if head == "label":
+            insn.append(rest[0])
+        elif head in JUMP_OPCODES:
+            label_name = rest[0]
+
+            if label_name in symbols:
+                insn.append(symbols[label_name])
+            else:
+                errors.append((lineno, f"label not found ({label_name})"))
+        else:
+            for arg in rest:
+                insn.append(to_machine_code_operand(arg))
+
+        insns.append(insn)
 
-src = read_stdin_all()
-asm_insns = parse(src)
-label_addr_map = create_label_addr_map(asm_insns)
+    if len(errors) > 0:
+        raise Exception("\n".join(
+            f"line {lineno}: {msg}" for lineno, msg in sorted(errors)
+        ))
 
-for asm_insn in asm_insns:
-    head = asm_insn[0]
-    rest = asm_insn[1:]
+    return (insns, symbols)
 
-    insn = [head]
-    if head == "label":
-        insn.append(rest[0])
-    elif head == "jmp" or head == "je" or head == "call":
-        label_name = rest[0]
+def assemble(lines):
+    insns, _ = assemble_with_symbols(lines)
+    return insns
 
-        if label_name in label_addr_map:
-            insn.append(label_addr_map[label_name])
+# --------------------------------
+# separate assembly and linking
+
+# Same as assemble(), but jump targets are left as label names, so that
+# fragments can be assembled independently and linked later.
+def assemble_fragment(lines):
+    insns = []
+    for _, aline in to_numbered_alines(lines):
+        head = aline[0]
+        rest = aline[1:]
+
+        insn = [head]
+        if head == "label" or head in JUMP_OPCODES:
+            insn.append(rest[0])
         else:
-            raise Exception(f"label not found ({label_name})")
+            for arg in rest:
+                insn.append(to_machine_code_operand(arg))
+
+        insns.append(insn)
+
+    return insns
+
+# fragments: [(name, instructions from assemble_fragment()), ...]
+#   name: shown in error messages (e.g. the function name)
+# => (insns, symbol table)
+def link(fragments):
+    symbols = {}
+    label_fragment_names = {} # label name => fragment name
+    errors = []
+
+    addr = 0
+    for fragment_name, fragment in fragments:
+        for insn in fragment:
+            if insn[0] == "label":
+                name = insn[1]
+                if name in symbols:
+                    errors.append(
+                        f"{fragment_name}: duplicate label ({name})"
+                        f" (first defined in {label_fragment_names[name]})"
+                    )
+                else:
+                    symbols[name] = addr + 1
+                    label_fragment_names[name] = fragment_name
+            addr += 1
+
+    insns = []
+    for fragment_name, fragment in fragments:
+        for insn in fragment:
+            if insn[0] in JUMP_OPCODES:
+                label_name = insn[1]
+                if label_name in symbols:
+                    insns.append([insn[0], symbols[label_name]])
+                else:
+                    errors.append(f"{fragment_name}: label not found ({label_name})")
+            else:
+                insns.append(insn)
+
+    if len(errors) > 0:
+        raise Exception("\n".join(errors))
+
+    return (insns, symbols)
+
+# --------------------------------
+
+def write_symbols(path, symbols):
+    with open(path, "w") as f:
+        json.dump(symbols, f, indent=2)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--binary", action="store_true",
+        help="write the executable in the binary format"
+    )
+    parser.add_argument(
+        "--symbols", metavar="FILE",
+        help="write the symbol table (label => address) as JSON"
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    insns, symbols = assemble_with_symbols(sys.stdin)
+
+    if args.symbols != None:
+        write_symbols(args.symbols, symbols)
+
+    if args.binary:
+        sys.stdout.buffer.write(mrcl_exe.dump(insns))
     else:
-        for arg in rest:
-            insn.append(to_machine_code_operand(arg))
+        for insn in insns:
+            print(json.dumps(insn))
 
-    print(json.dumps(insn))
+if __name__ == "__main__":
+    main()
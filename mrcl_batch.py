@@ -0,0 +1,208 @@
+import argparse
+import json
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mrcl_vm import Memory, Vm
+
+# Runs many headless VM jobs on a process pool and yields the results as
+# each job finishes.
+#
+# job:
+#   {
+#     "id": ...,             (optional; defaults to the index of the job)
+#     "program": path,       (JSON lines or binary executable)
+#     "vram": [...],         (optional initial VRAM image)
+#     "stack": [...],        (optional initial stack image)
+#     "max_steps": N,        (optional)
+#     "timeout": sec,        (optional; wall clock time of the run)
+#     "vram_width": N,       (optional; also vram_height and vram_pages,
+#                             see mrcl_vm.Memory)
+#   }
+#
+# result:
+#   { "id": ..., "status": "exited" | "step_limit" | "timeout" | "error",
+#     "time": sec, "state": {...} } (or "error": message)
+
+STACK_SIZE = 50
+
+DEFAULT_VRAM_GEOMETRY = {
+    "vram_width": Memory.DEFAULT_VRAM_WIDTH,
+    "vram_height": Memory.DEFAULT_VRAM_HEIGHT,
+    "vram_pages": Memory.DEFAULT_VRAM_PAGES,
+}
+
+# the deadline is checked between slices
+SLICE_STEPS = 10_000
+
+# path => insns; each worker process loads a program only once
+g_programs = {}
+
+def load_program(vm, path):
+    if path not in g_programs:
+        vm.load_program_file(path)
+        g_programs[path] = vm.mem.main
+    else:
+        vm.load_program(g_programs[path])
+
+def apply_image(dest, image, name):
+    if len(image) > len(dest):
+        raise Exception(f"{name} image too large ({len(image)} > {len(dest)})")
+    dest[:len(image)] = array("q", image)
+
+# => keyword arguments of create_vm(), from job (or params) and defaults
+def get_vram_geometry(job):
+    return {
+        key: default if job.get(key) == None else job[key]
+        for key, default in DEFAULT_VRAM_GEOMETRY.items()
+    }
+
+def create_vm(
+    engine,
+    vram_width=Memory.DEFAULT_VRAM_WIDTH,
+    vram_height=Memory.DEFAULT_VRAM_HEIGHT,
+    vram_pages=Memory.DEFAULT_VRAM_PAGES
+):
+    mem = Memory(STACK_SIZE, vram_width, vram_height, vram_pages)
+    if engine == "jit":
+        from mrcl_jit import JitVm
+        return JitVm(mem, STACK_SIZE)
+    else:
+        return Vm(mem, STACK_SIZE)
+
+def run_vm(vm, max_steps, deadline):
+    step_limit = None if max_steps is None else vm.step + max_steps
+
+    while True:
+        steps = SLICE_STEPS
+        if step_limit != None:
+            steps = min(steps, step_limit - vm.step)
+
+        state = vm.run(steps)
+        if state["exited"]:
+            return ("exited", state)
+        elif step_limit != None and vm.step >= step_limit:
+            return ("step_limit", state)
+        elif deadline != None and time.monotonic() >= deadline:
+            return ("timeout", state)
+
+def run_job(job, engine="interp"):
+    t0 = time.monotonic()
+    result = { "id": job["id"] }
+
+    try:
+        vm = create_vm(engine, **get_vram_geometry(job))
+        load_program(vm, job["program"])
+
+        if job.get("vram") != None:
+            apply_image(vm.mem.vram, job["vram"], "vram")
+        if job.get("stack") != None:
+            apply_image(vm.mem.stack, job["stack"], "stack")
+
+        timeout = job.get("timeout")
+        deadline = None if timeout is None else t0 + timeout
+        status, state = run_vm(vm, job.get("max_steps"), deadline)
+
+        result["status"] = status
+        result["state"] = state
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+
+    result["time"] = time.monotonic() - t0
+    return result
+
+# Yields results in completion order.
+def run_batch(jobs, workers=None, engine="interp"):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for i, job in enumerate(jobs):
+            job = dict(job)
+            job.setdefault("id", i)
+            futures.append(executor.submit(run_job, job, engine))
+
+        for future in as_completed(futures):
+            yield future.result()
+
+# --------------------------------
+
+# one image per line:
+#   {"vram": [...], "stack": [...]}   or   [...] (VRAM only)
+def read_images(path):
+    images = []
+    with open(path) as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            image = json.loads(line)
+            if type(image) == list:
+                image = { "vram": image }
+            images.append(image)
+    return images
+
+def create_jobs(args):
+    common = {
+        "max_steps": args.max_steps,
+        "timeout": args.timeout,
+        "vram_width": args.vram_width,
+        "vram_height": args.vram_height,
+        "vram_pages": args.vram_pages,
+    }
+
+    if args.images != None:
+        if len(args.programs) != 1:
+            raise Exception("--images requires exactly one program")
+        program = args.programs[0]
+        return [
+            dict(common, program=program, **image)
+            for image in read_images(args.images)
+        ]
+    else:
+        return [
+            dict(common, id=program, program=program)
+            for program in args.programs
+        ]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("programs", nargs="+", metavar="exe_file")
+    parser.add_argument(
+        "--images", metavar="FILE",
+        help="run one program against each initial image in FILE (JSON lines)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of worker processes (default: number of CPUs)"
+    )
+    parser.add_argument("--max-steps", type=int, default=None)
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="wall clock limit of each job in seconds"
+    )
+    parser.add_argument("--engine", choices=["interp", "jit"], default="interp")
+    parser.add_argument("--vram-width", type=int, default=None)
+    parser.add_argument("--vram-height", type=int, default=None)
+    parser.add_argument(
+        "--vram-pages", type=int, default=None,
+        help="number of width x height pages (default: 2)"
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    jobs = create_jobs(args)
+
+    num_failed = 0
+    for result in run_batch(jobs, args.workers, args.engine):
+        if result["status"] in ("error", "timeout"):
+            num_failed += 1
+        print(json.dumps(result), flush=True)
+
+    if num_failed > 0:
+        print(f"{num_failed} of {len(jobs)} jobs failed", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
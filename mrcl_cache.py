@@ -0,0 +1,134 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+
+# Content-addressed on-disk cache for compiler outputs.
+#
+#   <cache dir>/<key[:2]>/<key>.<stage>
+#
+# key: sha256 of the compiler version, the options and the source text.
+# Each stage (tokens, tree, asm, exe) is stored in its own file, so a hit
+# on any stage skips the stages before it.
+#
+# Files are written to a temporary file and renamed into place, so
+# concurrent writers and readers never see partial files. Reads touch the
+# file's mtime, and eviction removes the least recently used files until
+# the cache is below its size limit.
+#
+# The total size is scanned once and then estimated from the writes of
+# this process; the directory is scanned again only when the estimate
+# exceeds the limit.
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# eviction makes room down to this ratio of the limit
+EVICT_RATIO = 0.8
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules whose code affects the compiler output
+COMPILER_MODULES = [
+    "mrcl_lexer.py", "mrcl_parser.py", "mrcl_codegen.py",
+    "mrcl_peephole.py", "mrcl_asm.py", "lib/common.py",
+]
+
+@functools.lru_cache(maxsize=None)
+def compiler_version():
+    h = hashlib.sha256()
+    for name in COMPILER_MODULES:
+        with open(os.path.join(PROJECT_DIR, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def make_key(src, options=None):
+    h = hashlib.sha256()
+    h.update(compiler_version().encode("ascii"))
+    h.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    h.update(b"\0")
+    h.update(src.encode("utf-8"))
+    return h.hexdigest()
+
+class CompileCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = None # estimate
+
+    def path(self, key, stage):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{stage}")
+
+    # => str, or None on a miss
+    def get(self, key, stage):
+        path = self.path(key, stage)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # not cached, or evicted by another process
+            return None
+        return data
+
+    def put(self, key, stage, data):
+        path = self.path(key, stage)
+        dir_ = os.path.dirname(path)
+        os.makedirs(dir_, exist_ok=True)
+
+        encoded = data.encode("utf-8")
+        fd, temp_path = tempfile.mkstemp(dir=dir_, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encoded)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        if self.total_bytes == None:
+            self.total_bytes = sum(size for _, size, _ in self.list_entries())
+        else:
+            self.total_bytes += len(encoded)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    # => [(mtime, size, path), ...]
+    def list_entries(self):
+        entries = []
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.startswith(".tmp_"):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self.list_entries()
+        total = sum(size for _, size, _ in entries)
+
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * EVICT_RATIO:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+        self.total_bytes = total
+
+    def clear(self):
+        for _, _, path in self.list_entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.total_bytes = 0
@@ -0,0 +1,101 @@
+import json
+import os
+import struct
+import zlib
+from array import array
+
+from mrcl_vm import Memory, Vm
+
+# Checkpoint file
+#
+#   header   magic "MRCLCKP\0", version (u16)
+#   body     zlib compressed JSON: program, registers, stack and VRAM
+#
+# A checkpoint holds the complete machine state, so it can be restored
+# into a fresh Vm without the executable file.
+
+MAGIC = b"MRCLCKP\0"
+VERSION = 1
+
+HEADER = struct.Struct("<8sH")
+
+REG_NAMES = ["pc", "reg_a", "reg_b", "zf", "sp", "bp", "step"]
+
+def snapshot(vm):
+    data = { name: getattr(vm, name) for name in REG_NAMES }
+    data["program"] = vm.mem.main
+    data["stack"] = list(vm.mem.stack)
+    data["vram"] = list(vm.mem.vram)
+    data["vram_width"] = vm.mem.vram_width
+    data["vram_height"] = vm.mem.vram_height
+    return data
+
+def restore(data, vm_class=Vm):
+    stack_size = len(data["stack"])
+    vram_width = data.get("vram_width", Memory.DEFAULT_VRAM_WIDTH)
+    vram_height = data.get("vram_height", Memory.DEFAULT_VRAM_HEIGHT)
+    vram_pages = len(data["vram"]) // (vram_width * vram_height)
+    mem = Memory(stack_size, vram_width, vram_height, vram_pages)
+    vm = vm_class(mem, stack_size)
+    vm.load_program(data["program"])
+
+    mem.stack[:] = array("q", data["stack"])
+    mem.vram[:] = array("q", data["vram"])
+    for name in REG_NAMES:
+        setattr(vm, name, data[name])
+
+    return vm
+
+# Independent copy of the machine, e.g. to run many continuations of a
+# warmed-up state.
+def fork(vm, vm_class=None):
+    return restore(snapshot(vm), vm_class or type(vm))
+
+# --------------------------------
+
+def dumps(vm):
+    body = json.dumps(snapshot(vm), separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(MAGIC, VERSION) + zlib.compress(body)
+
+def loads(buf, vm_class=Vm):
+    magic, version = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise Exception("not a checkpoint file")
+    if version != VERSION:
+        raise Exception(f"unsupported checkpoint version ({version})")
+
+    data = json.loads(zlib.decompress(buf[HEADER.size:]).decode("utf-8"))
+    return restore(data, vm_class)
+
+# Writes to a temporary file first so that a crash while saving does not
+# destroy the previous checkpoint.
+def save(vm, path):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(dumps(vm))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+def load(path, vm_class=Vm):
+    with open(path, "rb") as f:
+        return loads(f.read(), vm_class)
+
+# Runs headless and saves a checkpoint every `every` steps
+# (and once more when the run ends).
+def run_with_checkpoints(vm, path, every, max_steps=None):
+    step_limit = None if max_steps is None else vm.step + max_steps
+
+    while True:
+        steps = every
+        if step_limit != None:
+            steps = min(steps, step_limit - vm.step)
+
+        state = vm.run(steps)
+        save(vm, path)
+
+        if state["exited"] or (step_limit != None and vm.step >= step_limit):
+            return state
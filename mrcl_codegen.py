@@ -1,4 +1,4 @@
-import json, re, sys
+import argparse, json, re, sys
 
 from lib.common import read_stdin_all, puts_e, inspect, p_e
 
@@ -10,19 +10,35 @@ def not_yet_impl(k, v):
 # --------------------------------
 
 g_label_id = 0
+g_out = [] # generated instructions
+g_reg_b_leaf = False # load leaf operands directly into reg_b
+g_called_fn_names = set()
+g_inline_vram = False # emit set_vram / get_vram at call sites
+g_label_prefix = None # function name, for function-local label names
+
+def emit(*insn):
+    g_out.append(insn)
+
+def emit_blank():
+    g_out.append(())
+
+def emit_comment(comment):
+    g_out.append(("#", comment))
 
 def get_label_id():
     global g_label_id
     g_label_id += 1
+    if g_label_prefix != None:
+        return f"{g_label_prefix}_{g_label_id}"
     return g_label_id
 
 def asm_prologue():
-    print("  push bp")
-    print("  mov bp sp")
+    emit("push", "bp")
+    emit("mov", "bp", "sp")
 
 def asm_epilogue():
-    print("  mov sp bp")
-    print("  pop bp")
+    emit("mov", "sp", "bp")
+    emit("pop", "bp")
 
 def to_fn_arg_disp(fn_arg_names, fn_arg_name):
     i = fn_arg_names.index(fn_arg_name)
@@ -35,14 +51,10 @@ def to_lvar_disp(lvar_names, lvar_name):
 # --------------------------------
 
 def _gen_expr_add():
-    print("  pop reg_b")
-    print("  pop reg_a")
-    print("  add reg_a reg_b")
+    emit("add", "reg_a", "reg_b")
 
 def _gen_expr_mult():
-    print("  pop reg_b")
-    print("  pop reg_a")
-    print("  mul reg_b")
+    emit("mul", "reg_b")
 
 def _gen_expr_eq_neq(name, then_val, else_val):
     label_id = get_label_id()
@@ -50,19 +62,16 @@ def _gen_expr_eq_neq(name, then_val, else_val):
     label_end = f"end_{name}_{label_id}"
     label_then = f"then_{label_id}"
 
-    print(f"  pop reg_b")
-    print(f"  pop reg_a")
-
-    print(f"  cmp")
-    print(f"  je {label_then}")
+    emit("cmp")
+    emit("je", label_then)
 
-    print(f"  mov reg_a {else_val}")
-    print(f"  jmp {label_end}")
+    emit("mov", "reg_a", else_val)
+    emit("jmp", label_end)
 
-    print(f"label {label_then}")
-    print(f"  mov reg_a {then_val}")
+    emit("label", label_then)
+    emit("mov", "reg_a", then_val)
 
-    print(f"label {label_end}")
+    emit("label", label_end)
 
 def _gen_expr_eq():
     _gen_expr_eq_neq("eq", 1, 0)
@@ -70,16 +79,31 @@ def _gen_expr_eq():
 def _gen_expr_neq():
     _gen_expr_eq_neq("neq", 0, 1)
 
+# int, function argument or local variable => operand (1, [bp:2], [bp:-1])
+# otherwise => None
+def to_leaf_operand(fn_arg_names, lvar_names, expr):
+    if type(expr) == int:
+        return expr
+    elif type(expr) == str:
+        if expr in fn_arg_names:
+            disp = to_fn_arg_disp(fn_arg_names, expr)
+            return f"[bp:{disp}]"
+        elif expr in lvar_names:
+            disp = to_lvar_disp(lvar_names, expr)
+            return f"[bp:{disp}]"
+
+    return None
+
 def gen_expr(fn_arg_names, lvar_names, expr):
     if type(expr) == int:
-        print(f"  mov reg_a {expr}")
+        emit("mov", "reg_a", expr)
     elif type(expr) == str:
         if expr in fn_arg_names:
             disp = to_fn_arg_disp(fn_arg_names, expr)
-            print(f"  mov reg_a [bp:{disp}]")
+            emit("mov", "reg_a", f"[bp:{disp}]")
         elif expr in lvar_names:
             disp = to_lvar_disp(lvar_names, expr)
-            print(f"  mov reg_a [bp:{disp}]")
+            emit("mov", "reg_a", f"[bp:{disp}]")
         else:
             raise not_yet_impl("expr", expr)
     elif type(expr) == list:
@@ -94,10 +118,24 @@ def _gen_expr_binary(fn_arg_names, lvar_names, expr):
     arg_l = args[0]
     arg_r = args[1]
 
-    gen_expr(fn_arg_names, lvar_names, arg_l)
-    print(f"  push reg_a")
-    gen_expr(fn_arg_names, lvar_names, arg_r)
-    print(f"  push reg_a")
+    leaf_l = to_leaf_operand(fn_arg_names, lvar_names, arg_l)
+    leaf_r = to_leaf_operand(fn_arg_names, lvar_names, arg_r)
+
+    if g_reg_b_leaf and leaf_r != None:
+        gen_expr(fn_arg_names, lvar_names, arg_l)
+        emit("mov", "reg_b", leaf_r)
+    elif g_reg_b_leaf and leaf_l != None:
+        # all operators are commutative
+        gen_expr(fn_arg_names, lvar_names, arg_r)
+        emit("mov", "reg_b", leaf_l)
+    else:
+        gen_expr(fn_arg_names, lvar_names, arg_l)
+        emit("push", "reg_a")
+        gen_expr(fn_arg_names, lvar_names, arg_r)
+        emit("push", "reg_a")
+
+        emit("pop", "reg_b")
+        emit("pop", "reg_a")
 
     if operator == "+":
         _gen_expr_add()
@@ -110,17 +148,60 @@ def _gen_expr_binary(fn_arg_names, lvar_names, expr):
     else:
         raise not_yet_impl("todo", operator)
 
+# call set_vram(addr, val) => set_vram addr val
+# Like the builtin (where addr is the last argument evaluated), addr is
+# left in reg_a.
+def _gen_inline_set_vram(fn_arg_names, lvar_names, fn_args):
+    arg_addr, arg_val = fn_args
+
+    leaf_addr = to_leaf_operand(fn_arg_names, lvar_names, arg_addr)
+    leaf_val = to_leaf_operand(fn_arg_names, lvar_names, arg_val)
+
+    if leaf_val != None:
+        gen_expr(fn_arg_names, lvar_names, arg_addr)
+        emit("set_vram", "reg_a", leaf_val)
+    elif leaf_addr != None:
+        gen_expr(fn_arg_names, lvar_names, arg_val)
+        emit("set_vram", leaf_addr, "reg_a")
+        emit("mov", "reg_a", leaf_addr)
+    else:
+        gen_expr(fn_arg_names, lvar_names, arg_val)
+        emit("push", "reg_a")
+        gen_expr(fn_arg_names, lvar_names, arg_addr)
+        emit("pop", "reg_b")
+        emit("set_vram", "reg_a", "reg_b")
+
+# call get_vram(addr) => get_vram addr reg_a
+def _gen_inline_get_vram(fn_arg_names, lvar_names, fn_args):
+    arg_addr = fn_args[0]
+
+    leaf_addr = to_leaf_operand(fn_arg_names, lvar_names, arg_addr)
+    if leaf_addr == None:
+        gen_expr(fn_arg_names, lvar_names, arg_addr)
+        leaf_addr = "reg_a"
+    emit("get_vram", leaf_addr, "reg_a")
+
 def _gen_funcall(fn_arg_names, lvar_names, funcall):
     fn_name = funcall[0]
     fn_args = funcall[1:]
 
+    if g_inline_vram:
+        if fn_name == "set_vram" and len(fn_args) == 2:
+            _gen_inline_set_vram(fn_arg_names, lvar_names, fn_args)
+            return
+        elif fn_name == "get_vram" and len(fn_args) == 1:
+            _gen_inline_get_vram(fn_arg_names, lvar_names, fn_args)
+            return
+
     for fn_arg in reversed(fn_args):
         gen_expr(fn_arg_names, lvar_names, fn_arg)
-        print(f"  push reg_a")
+        emit("push", "reg_a")
+
+    g_called_fn_names.add(fn_name)
 
     gen_vm_comment(f"call  {fn_name}")
-    print(f"  call {fn_name}")
-    print(f"  add sp {len(fn_args)}")
+    emit("call", fn_name)
+    emit("add", "sp", len(fn_args))
 
 def gen_call(fn_arg_names, lvar_names, stmt):
     funcall = stmt[1]
@@ -133,15 +214,15 @@ def gen_call_set(fn_arg_names, lvar_names, stmt):
     _gen_funcall(fn_arg_names, lvar_names, funcall)
 
     disp = to_lvar_disp(lvar_names, lvar_name)
-    print(f"  mov [bp:{disp}] reg_a")
+    emit("mov", f"[bp:{disp}]", "reg_a")
 
 def gen_return(fn_arg_names, lvar_names, stmt):
     retval = stmt[1]
     gen_expr(fn_arg_names, lvar_names, retval)
 
-    print("")
+    emit_blank()
     asm_epilogue()
-    print("  ret")
+    emit("ret")
 
 def _gen_set(fn_arg_names, lvar_names, dest, expr):
     gen_expr(fn_arg_names, lvar_names, expr)
@@ -149,7 +230,7 @@ def _gen_set(fn_arg_names, lvar_names, dest, expr):
 
     if dest in lvar_names:
         disp = to_lvar_disp(lvar_names, dest)
-        print(f"  mov [bp:{disp}] {src_val}")
+        emit("mov", f"[bp:{disp}]", src_val)
     else:
         raise not_yet_impl("dest", dest)
 
@@ -168,21 +249,21 @@ def gen_while(fn_arg_names, lvar_names, stmt):
     label_begin = f"while_{label_id}"
     label_end = f"end_while_{label_id}"
 
-    print("")
+    emit_blank()
 
-    print(f"label {label_begin}")
+    emit("label", label_begin)
 
     gen_expr(fn_arg_names, lvar_names, cond_expr)
 
-    print(f"  mov reg_b 0")
-    print(f"  cmp")
+    emit("mov", "reg_b", 0)
+    emit("cmp")
 
-    print(f"  je {label_end}")
+    emit("je", label_end)
 
     gen_stmts(fn_arg_names, lvar_names, stmts)
-    print(f"  jmp {label_begin}")
-    print(f"label {label_end}")
-    print("")
+    emit("jmp", label_begin)
+    emit("label", label_end)
+    emit_blank()
 
 def gen_case(fn_arg_names, lvar_names, stmt):
     when_clauses = stmt[1:]
@@ -196,27 +277,27 @@ def gen_case(fn_arg_names, lvar_names, stmt):
         when_idx += 1
         cond  = when_clause[0]
         stmts = when_clause[1:]
-        print(f"  # 条件 {label_id}_{when_idx}: {cond}")
+        emit_comment(f"条件 {label_id}_{when_idx}: {cond}")
 
         gen_expr(fn_arg_names, lvar_names, cond)
 
-        print(f"  mov reg_b 0")
-        print(f"  cmp")
-        print(f"  je {label_end_when_head}_{when_idx}")
+        emit("mov", "reg_b", 0)
+        emit("cmp")
+        emit("je", f"{label_end_when_head}_{when_idx}")
 
         gen_stmts(fn_arg_names, lvar_names, stmts)
 
-        print(f"  jmp {label_end}")
+        emit("jmp", label_end)
 
-        print(f"label {label_end_when_head}_{when_idx}")
+        emit("label", f"{label_end_when_head}_{when_idx}")
 
-    print(f"label {label_end}")
+    emit("label", label_end)
 
 def gen_vm_comment(comment):
-    print("  _cmt " + comment.replace(" ", "~"))
+    emit("_cmt", comment.replace(" ", "~"))
 
 def gen_debug(comment):
-    print("  _debug")
+    emit("_debug")
 
 def gen_stmt(fn_arg_names, lvar_names, stmt):
     stmt_head = stmt[0]
@@ -245,7 +326,7 @@ def gen_stmts(fn_arg_names, lvar_names, stmts):
         gen_stmt(fn_arg_names, lvar_names, stmt)
 
 def gen_var(fn_arg_names, lvar_names, stmt):
-    print("  add sp -1")
+    emit("add", "sp", -1)
     if len(stmt) == 3:
         dest = stmt[1]
         expr = stmt[2]
@@ -256,12 +337,12 @@ def gen_func_def(func_def):
     fn_arg_names = func_def[2]
     stmts        = func_def[3]
 
-    print("")
-    print(f"label {fn_name}")
+    emit_blank()
+    emit("label", fn_name)
     asm_prologue()
 
-    print("")
-    print("  # 関数の処理本体")
+    emit_blank()
+    emit_comment("関数の処理本体")
 
     lvar_names = [] # local variable names
 
@@ -274,9 +355,9 @@ def gen_func_def(func_def):
         else:
             gen_stmt(fn_arg_names, lvar_names, stmt)
 
-    print("")
+    emit_blank()
     asm_epilogue()
-    print("  ret")
+    emit("ret")
 
 def gen_top_stmts(tree):
     top_stmts = tree[1:]
@@ -290,38 +371,255 @@ def gen_top_stmts(tree):
             raise not_yet_impl("top_stmt", top_stmt)
 
 def gen_builtin_set_vram():
-    print(f"")
-    print(f"label set_vram")
+    emit_blank()
+    emit("label", "set_vram")
     asm_prologue()
 
-    print(f"  set_vram [bp:2] [bp:3]") # vram_addr value
+    emit("set_vram", "[bp:2]", "[bp:3]") # vram_addr value
 
     asm_epilogue()
-    print(f"  ret")
+    emit("ret")
 
 def gen_builtin_get_vram():
-    print(f"")
-    print(f"label get_vram")
+    emit_blank()
+    emit("label", "get_vram")
     asm_prologue()
 
-    print(f"  get_vram [bp:2] reg_a") # vram_addr dest
+    emit("get_vram", "[bp:2]", "reg_a") # vram_addr dest
 
     asm_epilogue()
-    print(f"  ret")
+    emit("ret")
+
+def gen_builtin_copy_vram():
+    emit_blank()
+    emit("label", "copy_vram")
+    asm_prologue()
 
-def codegen(tree):
-    print("  call main")
-    print("  exit")
+    emit("copy_vram", "[bp:2]", "[bp:3]", "[bp:4]") # dest src size
 
-    gen_top_stmts(tree)
+    asm_epilogue()
+    emit("ret")
 
-    print("#>builtins")
+def gen_builtin_fill_vram():
+    emit_blank()
+    emit("label", "fill_vram")
+    asm_prologue()
+
+    emit("fill_vram", "[bp:2]", "[bp:3]", "[bp:4]") # vram_addr size value
+
+    asm_epilogue()
+    emit("ret")
+
+def gen_builtins(called_fn_names):
+    emit("#>builtins")
     gen_builtin_set_vram()
     gen_builtin_get_vram()
-    print("#<builtins")
+    # only when called, so that the output for other programs does not change
+    if "copy_vram" in called_fn_names:
+        gen_builtin_copy_vram()
+    if "fill_vram" in called_fn_names:
+        gen_builtin_fill_vram()
+    emit("#<builtins")
+
+# --------------------------------
+# constant folding
+
+def _fold_binary(operator, arg_l, arg_r):
+    if type(arg_l) == int and type(arg_r) == int:
+        if operator == "+":
+            return arg_l + arg_r
+        elif operator == "*":
+            return arg_l * arg_r
+        elif operator == "==":
+            return 1 if arg_l == arg_r else 0
+        elif operator == "!=":
+            return 1 if arg_l != arg_r else 0
+
+    if operator == "+" or operator == "*":
+        # + and * are commutative: keep the constant on the right
+        if type(arg_l) == int:
+            arg_l, arg_r = arg_r, arg_l
+
+        if operator == "+" and arg_r == 0:
+            return arg_l
+        elif operator == "*" and arg_r == 1:
+            return arg_l
+        elif operator == "*" and arg_r == 0:
+            # expressions have no side effects
+            return 0
+
+        # (x + 1) + 2 => x + 3
+        if (
+            type(arg_r) == int
+            and type(arg_l) == list and arg_l[0] == operator
+            and type(arg_l[2]) == int
+        ):
+            return _fold_binary(
+                operator,
+                arg_l[1],
+                _fold_binary(operator, arg_l[2], arg_r)
+            )
+
+    return [operator, arg_l, arg_r]
+
+def fold_expr(expr):
+    if type(expr) == list:
+        operator = expr[0]
+        arg_l = fold_expr(expr[1])
+        arg_r = fold_expr(expr[2])
+        return _fold_binary(operator, arg_l, arg_r)
+    else:
+        return expr
+
+def fold_stmt(stmt):
+    stmt_head = stmt[0]
+
+    if stmt_head == "var" and len(stmt) == 3:
+        return ["var", stmt[1], fold_expr(stmt[2])]
+    elif stmt_head == "set":
+        return ["set", stmt[1], fold_expr(stmt[2])]
+    elif stmt_head == "return":
+        return ["return", fold_expr(stmt[1])]
+    elif stmt_head == "while":
+        return ["while", fold_expr(stmt[1]), fold_stmts(stmt[2])]
+    elif stmt_head == "case":
+        return [
+            "case",
+            *[
+                [fold_expr(when_clause[0]), *fold_stmts(when_clause[1:])]
+                for when_clause in stmt[1:]
+            ]
+        ]
+    else:
+        return stmt
+
+def fold_stmts(stmts):
+    return [fold_stmt(stmt) for stmt in stmts]
+
+def fold_func_def(func_def):
+    _, fn_name, fn_arg_names, stmts = func_def
+    return ["func", fn_name, fn_arg_names, fold_stmts(stmts)]
+
+# Folds constant subexpressions and applies x+0, x*1 and x*0 in place of
+# the expressions of the tree. Returns a new tree.
+def fold_constants(tree):
+    top_stmts = []
+    for top_stmt in tree[1:]:
+        if top_stmt[0] == "func":
+            top_stmts.append(fold_func_def(top_stmt))
+        else:
+            top_stmts.append(top_stmt)
+
+    return ["top_stmts", *top_stmts]
+
+# --------------------------------
+
+def reset_state(reg_b_leaf=False, inline_vram=False, label_prefix=None):
+    global g_label_id
+    global g_out
+    global g_reg_b_leaf
+    global g_called_fn_names
+    global g_inline_vram
+    global g_label_prefix
+    g_label_id = 0
+    g_out = []
+    g_reg_b_leaf = reg_b_leaf
+    g_called_fn_names = set()
+    g_inline_vram = inline_vram
+    g_label_prefix = label_prefix
+
+def codegen(tree, fold=False, reg_b_leaf=False, inline_vram=False):
+    reset_state(reg_b_leaf, inline_vram)
+
+    if fold:
+        tree = fold_constants(tree)
+
+    emit("call", "main")
+    emit("exit")
+
+    gen_top_stmts(tree)
+
+    gen_builtins(g_called_fn_names)
+
+    return g_out
+
+# Parts of the program for incremental compilation (mrcl_incremental.py).
+# Label names generated in a function are prefixed with the function name,
+# so the code of a function does not depend on the other functions.
+
+def codegen_entry():
+    return [("call", "main"), ("exit",)]
+
+def codegen_func(func_def, fold=False, reg_b_leaf=False, inline_vram=False):
+    global g_label_prefix
+    reset_state(reg_b_leaf, inline_vram, label_prefix=func_def[1])
+
+    if fold:
+        func_def = fold_func_def(func_def)
+
+    try:
+        gen_func_def(func_def)
+    finally:
+        g_label_prefix = None
+
+    return g_out
+
+def codegen_builtins(called_fn_names):
+    reset_state()
+    gen_builtins(called_fn_names)
+    return g_out
+
+def to_asm_line(insn):
+    if len(insn) == 0:
+        return ""
+
+    head = insn[0]
+    if head == "label":
+        return f"label {insn[1]}"
+    elif head == "#":
+        return f"  # {insn[1]}"
+    elif head.startswith("#"):
+        return head
+    else:
+        return "  " + " ".join(map(str, insn))
+
+def to_asm_src(insns):
+    return "".join(to_asm_line(insn) + "\n" for insn in insns)
+
+def codegen_to_str(tree, fold=False, reg_b_leaf=False, inline_vram=False):
+    return to_asm_src(codegen(
+        tree, fold=fold, reg_b_leaf=reg_b_leaf, inline_vram=inline_vram
+    ))
 
 # --------------------------------
 
-src = read_stdin_all()
-tree = json.loads(src)
-codegen(tree)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fold", action="store_true",
+        help="fold constant expressions before generating code"
+    )
+    parser.add_argument(
+        "--reg-b", action="store_true",
+        help="load int/variable operands of binary expressions directly into reg_b"
+    )
+    parser.add_argument(
+        "--inline-vram", action="store_true",
+        help="emit set_vram/get_vram at call sites instead of calling the builtins"
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    src = read_stdin_all()
+    tree = json.loads(src)
+    sys.stdout.write(
+        codegen_to_str(
+            tree, fold=args.fold, reg_b_leaf=args.reg_b,
+            inline_vram=args.inline_vram
+        )
+    )
+
+if __name__ == "__main__":
+    main()
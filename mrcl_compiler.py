@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import sys
+
+import mrcl_lexer
+import mrcl_parser
+import mrcl_codegen
+import mrcl_peephole
+import mrcl_asm
+import mrcl_exe
+import mrcl_cache
+
+from lib.common import read_stdin_all, file_read, puts_e
+
+# Runs lexer, parser, codegen and assembler in a single process.
+# Each stage receives the previous stage's output as in-memory objects.
+
+STAGES = ["tokens", "tree", "asm", "exe"]
+
+def tokenize(src):
+    return mrcl_lexer.tokenize(src)
+
+def parse(tokens):
+    return mrcl_parser.parse(tokens)
+
+def codegen(tree, fold=False, reg_b_leaf=True, inline_vram=False):
+    return mrcl_codegen.codegen(
+        tree, fold=fold, reg_b_leaf=reg_b_leaf, inline_vram=inline_vram
+    )
+
+def optimize(asm_insns):
+    return mrcl_peephole.optimize(asm_insns)
+
+def assemble(asm_insns):
+    return mrcl_asm.assemble(asm_insns)
+
+def compile_source(
+    src, fold=False, reg_b_leaf=True, peephole=False, inline_vram=False
+):
+    tree = parse(mrcl_lexer.iter_tokens(src))
+    asm_insns = codegen(
+        tree, fold=fold, reg_b_leaf=reg_b_leaf, inline_vram=inline_vram
+    )
+    if peephole:
+        asm_insns, _ = optimize(asm_insns)
+    return assemble(asm_insns)
+
+# Runs the stages up to `emit` and returns its output:
+#   tokens => iterator of Token, tree => tree, asm => assembly text,
+#   exe => (insns, symbol table)
+def compile_to(src, emit="exe", fold=False, reg_b_leaf=True, peephole=False, inline_vram=False):
+    if emit == "tokens":
+        return mrcl_lexer.iter_tokens(src)
+
+    tree = parse(mrcl_lexer.iter_tokens(src))
+    if emit == "tree":
+        return tree
+
+    asm_insns = codegen(
+        tree, fold=fold, reg_b_leaf=reg_b_leaf, inline_vram=inline_vram
+    )
+    if peephole:
+        asm_insns, num_removed = optimize(asm_insns)
+        puts_e(f"peephole: removed {num_removed} instructions")
+
+    if emit == "asm":
+        return mrcl_codegen.to_asm_src(asm_insns)
+
+    return mrcl_asm.assemble_with_symbols(asm_insns)
+
+# Same as compile_to(), but takes the output of the latest stage found in
+# the cache and stores the outputs of the stages it runs.
+# Tokens and tree depend only on the source, asm and exe also on the
+# options.
+def compile_cached(src, cache, emit="exe", **options):
+    options = {
+        "fold": False, "reg_b_leaf": True, "peephole": False, "inline_vram": False,
+        **options
+    }
+    src_key = mrcl_cache.make_key(src)
+    opt_key = mrcl_cache.make_key(src, options)
+
+    if emit == "exe":
+        data = cache.get(opt_key, "exe")
+        if data != None:
+            exe = json.loads(data)
+            return (exe["insns"], exe["symbols"])
+
+    asm_src = None
+    if emit in ["asm", "exe"]:
+        asm_src = cache.get(opt_key, "asm")
+
+    if asm_src == None:
+        tree = None
+        if emit != "tokens":
+            data = cache.get(src_key, "tree")
+            if data != None:
+                tree = json.loads(data)
+
+        if tree == None:
+            data = cache.get(src_key, "tokens")
+            if data != None:
+                tokens = list(mrcl_parser.read_tokens(data))
+            else:
+                tokens = tokenize(src)
+                cache.put(
+                    src_key, "tokens",
+                    "".join(mrcl_lexer.to_json(token) + "\n" for token in tokens)
+                )
+            if emit == "tokens":
+                return iter(tokens)
+
+            tree = parse(tokens)
+            cache.put(src_key, "tree", json.dumps(tree))
+
+        if emit == "tree":
+            return tree
+
+        asm_insns = codegen(
+            tree, fold=options["fold"], reg_b_leaf=options["reg_b_leaf"],
+            inline_vram=options["inline_vram"]
+        )
+        if options["peephole"]:
+            asm_insns, _ = optimize(asm_insns)
+        asm_src = mrcl_codegen.to_asm_src(asm_insns)
+        cache.put(opt_key, "asm", asm_src)
+
+    if emit == "asm":
+        return asm_src
+
+    insns, symbols = mrcl_asm.assemble_with_symbols(asm_src.split("\n"))
+    cache.put(opt_key, "exe", json.dumps({ "insns": insns, "symbols": symbols }))
+    return (insns, symbols)
+
+# --------------------------------
+
+# options shared with mrcl_incremental.py
+
+def add_exe_args(parser):
+    parser.add_argument(
+        "--binary", action="store_true",
+        help="write the executable in the binary format"
+    )
+    parser.add_argument(
+        "--symbols", metavar="FILE",
+        help="write the symbol table (label => address) as JSON"
+    )
+
+def add_compile_args(parser):
+    parser.add_argument(
+        "--fold", action="store_true",
+        help="fold constant expressions before generating code"
+    )
+    parser.add_argument(
+        "--no-reg-b", dest="reg_b_leaf", action="store_false",
+        help="evaluate all operands of binary expressions through the stack"
+    )
+    parser.add_argument(
+        "--peephole", action="store_true",
+        help="run the peephole optimizer on the generated assembly"
+    )
+    parser.add_argument(
+        "--inline-vram", action="store_true",
+        help="emit set_vram/get_vram at call sites instead of calling the builtins"
+    )
+
+def add_cache_args(parser):
+    parser.add_argument(
+        "--cache", metavar="DIR", default=os.getenv("MRCL_CACHE_DIR"),
+        help="reuse and store compiler outputs in a cache directory (default: $MRCL_CACHE_DIR)"
+    )
+    parser.add_argument(
+        "--cache-max-mb", type=int, default=64,
+        help="size limit of the cache directory"
+    )
+
+# => keyword arguments of compile_source() etc.
+def get_compile_options(args):
+    return {
+        "fold": args.fold,
+        "reg_b_leaf": args.reg_b_leaf,
+        "peephole": args.peephole,
+        "inline_vram": args.inline_vram,
+    }
+
+def create_cache(args):
+    return mrcl_cache.CompileCache(args.cache, args.cache_max_mb * 1024 * 1024)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "src_file", nargs="?",
+        help="MRCL source file (default: stdin)"
+    )
+    parser.add_argument(
+        "--emit", choices=STAGES, default="exe",
+        help="stop after the given stage and print its output"
+             " (--binary and --symbols: exe only)"
+    )
+    add_exe_args(parser)
+    add_compile_args(parser)
+    add_cache_args(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.src_file == None:
+        src = read_stdin_all()
+    else:
+        src = file_read(args.src_file)
+
+    options = get_compile_options(args)
+    if args.cache != None:
+        cache = create_cache(args)
+        result = compile_cached(src, cache, args.emit, **options)
+    else:
+        result = compile_to(src, args.emit, **options)
+
+    if args.emit == "tokens":
+        for token in result:
+            print(mrcl_lexer.to_json(token))
+    elif args.emit == "tree":
+        print(json.dumps(result, indent=2))
+    elif args.emit == "asm":
+        sys.stdout.write(result)
+    else:
+        insns, symbols = result
+        if args.symbols != None:
+            mrcl_asm.write_symbols(args.symbols, symbols)
+
+        if args.binary:
+            sys.stdout.buffer.write(mrcl_exe.dump(insns))
+        else:
+            for insn in insns:
+                print(json.dumps(insn))
+
+if __name__ == "__main__":
+    main()
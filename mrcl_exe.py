@@ -0,0 +1,191 @@
+import mmap
+import re
+import struct
+
+# Binary executable format
+#
+#   header     magic "MRCLEXE\0", version (u16), reserved (u16),
+#              number of instructions (u32), number of constants (u32)
+#   constants  length (u32) + UTF-8 bytes, for each constant
+#              (label names, _cmt comments and other string operands)
+#   insns      fixed width (16 bytes) per instruction:
+#              opcode (u8), operand tags (u8 x 3),
+#              operand values (i32 x 3)
+#
+# Loading gives the same instruction lists as the JSON lines format:
+#   ["mov", "reg_a", "mem:bp:-1"]
+
+MAGIC = b"MRCLEXE\0"
+VERSION = 2
+
+HEADER = struct.Struct("<8sHHII")
+CONST_LEN = struct.Struct("<I")
+INSN = struct.Struct("<BBBBiii")
+
+# opcode numbers of this format; append only
+OPCODES = [
+    "exit", "mov", "add", "mul", "cmp", "label", "jmp", "je", "call", "ret",
+    "push", "pop", "set_vram", "get_vram", "_cmt",
+    "copy_vram", "fill_vram",
+]
+OPCODE_MAP = { name: i for i, name in enumerate(OPCODES) }
+
+MAX_OPERANDS = 3
+
+TAG_NONE      = 0
+TAG_INT       = 1 # value: the int
+TAG_STR       = 2 # value: index of the constant table
+TAG_REG       = 3 # value: index of REGS
+TAG_MEM_REG_A = 4 # value: displacement
+TAG_MEM_REG_B = 5
+TAG_MEM_BP    = 6
+TAG_MEM_SP    = 7
+
+REGS = ["reg_a", "reg_b", "bp", "sp"]
+MEM_TAGS = {
+    "reg_a": TAG_MEM_REG_A,
+    "reg_b": TAG_MEM_REG_B,
+    "bp": TAG_MEM_BP,
+    "sp": TAG_MEM_SP,
+}
+MEM_BASES = { tag: base for base, tag in MEM_TAGS.items() }
+
+INT_MIN = -(2 ** 31)
+INT_MAX = 2 ** 31 - 1
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# --------------------------------
+
+class ConstTable:
+    def __init__(self):
+        self.values = []
+        self.index_map = {}
+
+    def index(self, value):
+        if value not in self.index_map:
+            self.index_map[value] = len(self.values)
+            self.values.append(value)
+        return self.index_map[value]
+
+def check_int(value):
+    if not (INT_MIN <= value <= INT_MAX):
+        raise Exception(f"int out of range ({value})")
+    return value
+
+def encode_operand(arg, consts):
+    if type(arg) == int:
+        return (TAG_INT, check_int(arg))
+    elif arg in REGS:
+        return (TAG_REG, REGS.index(arg))
+
+    m = re.match(r"^mem:(.+):(-?\d+)$", arg)
+    if m and m.group(1) in MEM_TAGS:
+        return (MEM_TAGS[m.group(1)], check_int(int(m.group(2))))
+
+    return (TAG_STR, consts.index(arg))
+
+def encode_insn(insn, consts):
+    opcode = insn[0]
+    args = insn[1:]
+
+    if opcode not in OPCODE_MAP:
+        raise Exception(f"unknown opcode ({opcode})")
+    if len(args) > MAX_OPERANDS:
+        raise Exception(f"too many operands ({insn})")
+
+    tags = [TAG_NONE] * MAX_OPERANDS
+    values = [0] * MAX_OPERANDS
+    for i, arg in enumerate(args):
+        tags[i], values[i] = encode_operand(arg, consts)
+
+    return INSN.pack(OPCODE_MAP[opcode], *tags, *values)
+
+def dump(insns):
+    consts = ConstTable()
+    insn_bytes = [encode_insn(insn, consts) for insn in insns]
+
+    parts = [HEADER.pack(MAGIC, VERSION, 0, len(insns), len(consts.values))]
+    for value in consts.values:
+        encoded = value.encode("utf-8")
+        parts.append(CONST_LEN.pack(len(encoded)))
+        parts.append(encoded)
+    parts.extend(insn_bytes)
+
+    return b"".join(parts)
+
+# --------------------------------
+
+def decode_operand(tag, value, consts):
+    if tag == TAG_INT:
+        return value
+    elif tag == TAG_REG:
+        return REGS[value]
+    elif tag == TAG_STR:
+        return consts[value]
+    elif tag in MEM_BASES:
+        return f"mem:{MEM_BASES[tag]}:{value}"
+    else:
+        raise Exception(f"invalid operand tag ({tag})")
+
+def truncated_error(what):
+    return Exception(f"truncated executable ({what})")
+
+# A buffer that does not hold everything the header declares is rejected,
+# so that a partly written file is never run in part.
+def loads(buf):
+    if len(buf) < HEADER.size:
+        raise truncated_error("header")
+    magic, version, _, num_insns, num_consts = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise Exception("not a binary executable")
+    if version != VERSION:
+        raise Exception(f"unsupported executable version ({version})")
+
+    offset = HEADER.size
+    consts = []
+    for _ in range(num_consts):
+        if len(buf) < offset + CONST_LEN.size:
+            raise truncated_error("constants")
+        (size,) = CONST_LEN.unpack_from(buf, offset)
+        offset += CONST_LEN.size
+        if len(buf) < offset + size:
+            raise truncated_error("constants")
+        consts.append(bytes(buf[offset : offset + size]).decode("utf-8"))
+        offset += size
+
+    end = offset + num_insns * INSN.size
+    if len(buf) < end:
+        raise truncated_error(
+            f"{(len(buf) - offset) // INSN.size} of {num_insns} instructions"
+        )
+
+    operand_cache = {}
+    insns = []
+    for fields in INSN.iter_unpack(buf[offset:end]):
+        if fields[0] >= len(OPCODES):
+            raise Exception(f"invalid opcode ({fields[0]})")
+        insn = [OPCODES[fields[0]]]
+        tags = fields[1 : 1 + MAX_OPERANDS]
+        values = fields[1 + MAX_OPERANDS :]
+        for tag, value in zip(tags, values):
+            if tag == TAG_NONE:
+                break
+            key = (tag, value)
+            if key not in operand_cache:
+                operand_cache[key] = decode_operand(tag, value, consts)
+            insn.append(operand_cache[key])
+        insns.append(insn)
+
+    if len(insns) != num_insns:
+        raise truncated_error(f"{len(insns)} of {num_insns} instructions")
+
+    return insns
+
+def load(path):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as buf:
+                return loads(buf)
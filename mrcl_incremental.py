@@ -0,0 +1,200 @@
+import argparse
+import json
+import re
+import sys
+
+import mrcl_lexer
+import mrcl_parser
+import mrcl_codegen
+import mrcl_peephole
+import mrcl_asm
+import mrcl_exe
+import mrcl_cache
+import mrcl_compiler
+
+from lib.common import read_stdin_all, file_read, puts_e
+
+# Incremental compilation at function granularity.
+#
+# The source is split into the text spans of its functions with a quick
+# scan for top-level `func` keywords. Each function is generated with
+# function-local label names and assembled on its own into a fragment
+# whose jump targets are still label names. Fragments are cached by the
+# hash of the function's text and the options, so after an edit only the
+# changed functions go through the lexer, parser, codegen and assembler;
+# then all fragments are linked again.
+#
+# Label names differ from the non-incremental output (e.g. while_main_1
+# instead of while_1); the generated code is otherwise the same.
+
+# comments and strings (which may contain braces or "func"), braces, and
+# the func keyword; same rules as mrcl_lexer.RE_TOKEN
+RE_SPLIT = re.compile(r'//.*|".*"|[{}]|(?<![a-z0-9_])func(?![a-z0-9_])')
+
+# Splits the source into one text span per top-level function.
+# Text between functions belongs to the span before it, and text before
+# the first function to the first span.
+# => [(line number of the span, span), ...]
+def split_funcs(src):
+    starts = []
+    depth = 0
+    for m in RE_SPLIT.finditer(src):
+        s = m.group()
+        if s == "{":
+            depth += 1
+        elif s == "}":
+            depth -= 1
+        elif s == "func" and depth == 0:
+            starts.append(m.start())
+
+    if len(starts) == 0:
+        return [(1, src)]
+    starts[0] = 0
+
+    spans = []
+    lineno = 1
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(src)
+        span = src[start:end]
+        spans.append((lineno, span))
+        lineno += span.count("\n")
+    return spans
+
+# for error messages of mrcl_asm.link()
+def fragment_name(lineno, fragment):
+    # the code of a function starts with its label
+    if len(fragment) > 0 and fragment[0][0] == "label":
+        return f"func {fragment[0][1]} (line {lineno})"
+    else:
+        return f"line {lineno}"
+
+class IncrementalCompiler:
+    def __init__(
+        self, cache=None,
+        fold=False, reg_b_leaf=True, peephole=False, inline_vram=False
+    ):
+        self.cache = cache # mrcl_cache.CompileCache (optional)
+        self.options = {
+            "fold": fold,
+            "reg_b_leaf": reg_b_leaf,
+            "peephole": peephole,
+            "inline_vram": inline_vram,
+        }
+        self.fragments = {} # key => fragment, of the last compile()
+        self.num_compiled = 0
+        self.num_reused = 0
+
+    def span_key(self, span):
+        return mrcl_cache.make_key(span, self.options)
+
+    def assemble_part(self, asm_insns):
+        if self.options["peephole"]:
+            asm_insns, _ = mrcl_peephole.optimize(asm_insns)
+        return mrcl_asm.assemble_fragment(asm_insns)
+
+    def compile_span(self, lineno, span):
+        tree = mrcl_parser.parse(mrcl_lexer.iter_tokens(span, lineno))
+
+        fragment = []
+        for top_stmt in tree[1:]:
+            if top_stmt[0] != "func":
+                raise mrcl_codegen.not_yet_impl("top_stmt", top_stmt)
+
+            asm_insns = mrcl_codegen.codegen_func(
+                top_stmt,
+                fold=self.options["fold"],
+                reg_b_leaf=self.options["reg_b_leaf"],
+                inline_vram=self.options["inline_vram"]
+            )
+            fragment.extend(self.assemble_part(asm_insns))
+        return fragment
+
+    def get_fragment(self, lineno, span):
+        key = self.span_key(span)
+
+        fragment = self.fragments.get(key)
+        if fragment == None and self.cache != None:
+            data = self.cache.get(key, "fragment")
+            if data != None:
+                fragment = json.loads(data)
+
+        if fragment == None:
+            fragment = self.compile_span(lineno, span)
+            if self.cache != None:
+                self.cache.put(key, "fragment", json.dumps(fragment))
+            self.num_compiled += 1
+        else:
+            self.num_reused += 1
+
+        return (key, fragment)
+
+    # => (insns, symbol table)
+    def compile(self, src):
+        self.num_compiled = 0
+        self.num_reused = 0
+        fragments = {}
+
+        parts = [("(entry)", self.assemble_part(mrcl_codegen.codegen_entry()))]
+        called_fn_names = set()
+        for lineno, span in split_funcs(src):
+            key, fragment = self.get_fragment(lineno, span)
+            fragments[key] = fragment
+            parts.append((fragment_name(lineno, fragment), fragment))
+            for insn in fragment:
+                if insn[0] == "call":
+                    called_fn_names.add(insn[1])
+
+        parts.append(("(builtins)", self.assemble_part(
+            mrcl_codegen.codegen_builtins(called_fn_names)
+        )))
+
+        # keep only the fragments of the current source
+        self.fragments = fragments
+
+        return mrcl_asm.link(parts)
+
+# --------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "src_file", nargs="?",
+        help="MRCL source file (default: stdin)"
+    )
+    mrcl_compiler.add_exe_args(parser)
+    mrcl_compiler.add_compile_args(parser)
+    mrcl_compiler.add_cache_args(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.src_file == None:
+        src = read_stdin_all()
+    else:
+        src = file_read(args.src_file)
+
+    if args.cache == None:
+        puts_e("warning: no cache directory (--cache DIR), compiling everything")
+        cache = None
+    else:
+        cache = mrcl_compiler.create_cache(args)
+
+    compiler = IncrementalCompiler(cache, **mrcl_compiler.get_compile_options(args))
+    insns, symbols = compiler.compile(src)
+    puts_e(
+        f"incremental: compiled {compiler.num_compiled} functions,"
+        f" reused {compiler.num_reused}"
+    )
+
+    if args.symbols != None:
+        mrcl_asm.write_symbols(args.symbols, symbols)
+
+    if args.binary:
+        sys.stdout.buffer.write(mrcl_exe.dump(insns))
+    else:
+        for insn in insns:
+            print(json.dumps(insn))
+
+if __name__ == "__main__":
+    main()
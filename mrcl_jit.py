@@ -0,0 +1,261 @@
+from mrcl_vm import (
+    Vm,
+    OPCODE_MAP,
+    copy_vram, fill_vram,
+    OPND_INT, OPND_REG_A, OPND_REG_B, OPND_BP, OPND_SP, OPND_MEM,
+)
+
+# Translates the program into Python functions ("traces") with compile()/exec.
+#
+# A trace starts at some pc and follows the straight-line path through the
+# program: jmp and call are followed to their (static) targets, je exits the
+# trace when taken and falls through otherwise. A trace ends at ret, at an
+# address it has already visited, or when it gets too long.
+#
+# Registers are passed in and out as local variables:
+#
+#   def trace_12(reg_a, reg_b, zf, sp, bp):
+#       ...
+#       return (next_pc, num_steps, reg_a, reg_b, zf, sp, bp)
+#
+# Instructions that can not be translated (exit, unknown opcodes, invalid
+# operands) are left to the interpreter.
+
+MAX_TRACE_LEN = 64
+
+OP_EXIT     = OPCODE_MAP["exit"]
+OP_MOV      = OPCODE_MAP["mov"]
+OP_ADD      = OPCODE_MAP["add"]
+OP_MUL      = OPCODE_MAP["mul"]
+OP_CMP      = OPCODE_MAP["cmp"]
+OP_LABEL    = OPCODE_MAP["label"]
+OP_JMP      = OPCODE_MAP["jmp"]
+OP_JE       = OPCODE_MAP["je"]
+OP_CALL     = OPCODE_MAP["call"]
+OP_RET      = OPCODE_MAP["ret"]
+OP_PUSH     = OPCODE_MAP["push"]
+OP_POP      = OPCODE_MAP["pop"]
+OP_SET_VRAM = OPCODE_MAP["set_vram"]
+OP_GET_VRAM = OPCODE_MAP["get_vram"]
+OP_CMT      = OPCODE_MAP["_cmt"]
+OP_COPY_VRAM = OPCODE_MAP["copy_vram"]
+OP_FILL_VRAM = OPCODE_MAP["fill_vram"]
+
+REG_NAMES = {
+    OPND_REG_A: "reg_a",
+    OPND_REG_B: "reg_b",
+    OPND_BP: "bp",
+    OPND_SP: "sp",
+}
+
+class UntranslatableError(Exception):
+    pass
+
+def to_py_expr(opnd):
+    kind = opnd[0]
+
+    if kind == OPND_INT:
+        return repr(opnd[1])
+    elif kind in REG_NAMES:
+        return REG_NAMES[kind]
+    elif kind == OPND_MEM:
+        return f"stack[{to_py_addr(opnd)}]"
+    else:
+        raise UntranslatableError()
+
+def to_py_addr(opnd):
+    _, base_opnd, disp = opnd
+    base = to_py_expr(base_opnd)
+
+    if disp == 0:
+        return base
+    elif disp < 0:
+        return f"{base} - {-disp}"
+    else:
+        return f"{base} + {disp}"
+
+def to_py_assign(opnd, expr):
+    kind = opnd[0]
+
+    if kind == OPND_SP:
+        return [
+            f"sp = {expr}",
+            "if sp < 0: raise Exception('stack overflow')",
+            "if sp > sp_max: raise Exception('stack underflow')",
+        ]
+    elif kind in REG_NAMES or kind == OPND_MEM:
+        return [f"{to_py_expr(opnd)} = {expr}"]
+    else:
+        raise UntranslatableError()
+
+def py_return(next_pc, num_steps):
+    return f"return ({next_pc}, {num_steps}, reg_a, reg_b, zf, sp, bp)"
+
+def translate_insn(insn, addr):
+    op = insn[0]
+
+    if op == OP_MOV:
+        return to_py_assign(insn[1], to_py_expr(insn[2]))
+    elif op == OP_ADD:
+        return to_py_assign(
+            insn[1], f"{to_py_expr(insn[1])} + {to_py_expr(insn[2])}"
+        )
+    elif op == OP_MUL:
+        return [f"reg_a = reg_a * {to_py_expr(insn[1])}"]
+    elif op == OP_CMP:
+        return ["zf = 1 if reg_a == reg_b else 0"]
+    elif op == OP_LABEL or op == OP_CMT:
+        return []
+    elif op == OP_PUSH:
+        return [
+            "if sp < 1: raise Exception('stack overflow')",
+            f"stack[sp - 1] = {to_py_expr(insn[1])}",
+            "sp -= 1",
+        ]
+    elif op == OP_POP:
+        return [
+            *to_py_assign(insn[1], "stack[sp]"),
+            "if sp >= sp_max: raise Exception('stack underflow')",
+            "sp += 1",
+        ]
+    elif op == OP_CALL:
+        return [
+            "if sp < 1: raise Exception('stack overflow')",
+            "sp -= 1",
+            f"stack[sp] = {addr + 1}",
+        ]
+    elif op == OP_SET_VRAM:
+        return [f"vram[{to_py_expr(insn[1])}] = {to_py_expr(insn[2])}"]
+    elif op == OP_GET_VRAM:
+        return to_py_assign(insn[2], f"vram[{to_py_expr(insn[1])}]")
+    elif op == OP_COPY_VRAM or op == OP_FILL_VRAM:
+        fn_name = "copy_vram" if op == OP_COPY_VRAM else "fill_vram"
+        args = ", ".join(to_py_expr(opnd) for opnd in insn[1:])
+        return [f"{fn_name}(vram, {args})"]
+    else:
+        raise UntranslatableError()
+
+# Returns (python source, max number of steps), or None if the instruction
+# at start_pc has to be interpreted.
+def translate_trace(code, start_pc, fn_name):
+    lines = []
+    visited = set()
+    pc = start_pc
+    num_steps = 0
+
+    while True:
+        if (
+            pc in visited
+            or num_steps >= MAX_TRACE_LEN
+            or not (0 <= pc < len(code))
+        ):
+            lines.append(py_return(pc, num_steps))
+            break
+
+        insn = code[pc]
+        op = insn[0]
+
+        if op == OP_JMP:
+            visited.add(pc)
+            num_steps += 1
+            pc = insn[1]
+        elif op == OP_JE:
+            visited.add(pc)
+            num_steps += 1
+            lines.append(f"if zf == 1: {py_return(insn[1], num_steps)}")
+            pc += 1
+        elif op == OP_RET:
+            num_steps += 1
+            lines.append("next_pc = stack[sp]")
+            lines.append("if sp >= sp_max: raise Exception('stack underflow')")
+            lines.append("sp += 1")
+            lines.append(f"return (next_pc, {num_steps}, reg_a, reg_b, zf, sp, bp)")
+            break
+        else:
+            try:
+                insn_lines = translate_insn(insn, pc)
+            except UntranslatableError:
+                # exit, unknown opcode, invalid operand, ...
+                if num_steps == 0:
+                    return None
+                lines.append(py_return(pc, num_steps))
+                break
+
+            visited.add(pc)
+            num_steps += 1
+            lines.extend(insn_lines)
+
+            if op == OP_CALL:
+                pc = insn[1]
+            else:
+                pc += 1
+
+    body = "\n".join("    " + line for line in lines)
+    src = f"def {fn_name}(reg_a, reg_b, zf, sp, bp):\n{body}\n"
+    return (src, num_steps)
+
+class JitVm(Vm):
+    __slots__ = ("traces", "namespace")
+
+    def __init__(self, mem, stack_size):
+        super().__init__(mem, stack_size)
+        self.traces = {}
+        self.namespace = {
+            "sp_max": stack_size - 1,
+            "copy_vram": copy_vram,
+            "fill_vram": fill_vram,
+        }
+
+    def load_program(self, insns):
+        super().load_program(insns)
+        self.traces = {}
+
+    def compile_trace(self, pc):
+        result = translate_trace(self.code, pc, f"trace_{pc}")
+
+        if result == None:
+            trace = (None, 1)
+        else:
+            src, max_steps = result
+            exec(compile(src, f"<trace_{pc}>", "exec"), self.namespace)
+            trace = (self.namespace[f"trace_{pc}"], max_steps)
+
+        self.traces[pc] = trace
+        return trace
+
+    def run(self, max_steps=None):
+        self.namespace["stack"] = self.mem.stack
+        self.namespace["vram"] = self.mem.vram
+
+        traces = self.traces
+        step_limit = None if max_steps is None else self.step + max_steps
+
+        pc = self.pc
+        step = self.step
+        reg_a, reg_b, zf, sp, bp = self.reg_a, self.reg_b, self.zf, self.sp, self.bp
+
+        while step_limit is None or step < step_limit:
+            trace = traces.get(pc)
+            if trace == None:
+                trace = self.compile_trace(pc)
+            fn, trace_steps = trace
+
+            if fn != None and (step_limit is None or step + trace_steps <= step_limit):
+                pc, n, reg_a, reg_b, zf, sp, bp = fn(reg_a, reg_b, zf, sp, bp)
+                step += n
+            else:
+                # fall back to the interpreter for a single step
+                self.pc, self.step = pc, step
+                self.reg_a, self.reg_b, self.zf, self.sp, self.bp = reg_a, reg_b, zf, sp, bp
+
+                self.step += 1
+                do_exit = self.execute()
+                if do_exit:
+                    return self.get_state(True)
+
+                pc, step = self.pc, self.step
+                reg_a, reg_b, zf, sp, bp = self.reg_a, self.reg_b, self.zf, self.sp, self.bp
+
+        self.pc, self.step = pc, step
+        self.reg_a, self.reg_b, self.zf, self.sp, self.bp = reg_a, reg_b, zf, sp, bp
+        return self.get_state(False)
@@ -3,73 +3,71 @@ import json, re, sys
 from lib.common import Token
 from lib.common import read_stdin_all
 
+def not_yet_impl(k, v):
+    return Exception(f"{k} ({v})")
+
 def to_json(token):
     return json.dumps(
         [token.lineno, token.kind, token.value]
     )
 
+KEYWORDS = frozenset([
+    "func", "return", "var", "set", "call", "call_set", "case", "when", "while",
+    "_cmt", "_debug"
+])
+
 def is_kw(value):
-    return value in [
-        "func", "return", "var", "set", "call", "call_set", "case", "when", "while",
-        "_cmt", "_debug"
-    ]
+    return value in KEYWORDS
 
-def tokenize(src):
-    tokens = []
+# Alternatives are tried in this order at each position
+RE_TOKEN = re.compile(
+    r"""
+      (?P<newline> \n )
+    | (?P<space> [ ]+ )
+    | (?P<comment> //.* ) (?=\n)
+    | " (?P<str> .* ) "
+    | (?P<int> -?[0-9]+ )
+    | (?P<sym> == | != | [(){}=;+*,] )
+    | (?P<ident> [a-z_][a-z0-9_]* )
+    """,
+    re.VERBOSE
+)
+
+# lineno: line number of the start of src
+def iter_tokens(src, lineno=1):
     pos = 0
-    lineno = 1
 
-    re_space = r"( +)"
-    re_comment = r"(//.*)\n"
-    re_str = r"\"(.*)\""
-    re_int = r"(-?[0-9]+)"
-    re_sym = r"(==|!=|[(){}=;+*,])"
-    re_ident = r"([a-z_][a-z0-9_]*)"
+    scanner = RE_TOKEN.scanner(src)
 
     while pos < len(src):
-        rest = src[pos:]
+        m = scanner.match()
+        if m == None:
+            raise not_yet_impl("rest", src[pos:])
 
-        if rest[0] == "\n":
-            pos += 1
+        kind = m.lastgroup
+        pos = m.end()
+
+        if kind == "newline":
             lineno += 1
-        elif re.match(re_space, rest):
-            m = re.match(re_space, rest)
-            s = m.group(1)
-            pos += len(s)
-        elif re.match(re_comment, rest):
-            m = re.match(re_comment, rest)
-            s = m.group(1)
-            pos += len(s)
-        elif re.match(re_str, rest):
-            m = re.match(re_str, rest)
-            s = m.group(1)
-            tokens.append(Token("str", s, lineno))
-            pos += len(s) + 2
-        elif re.match(re_int, rest):
-            m = re.match(re_int, rest)
-            s = m.group(1)
-            tokens.append(Token("int", s, lineno))
-            pos += len(s)
-        elif re.match(re_sym, rest):
-            m = re.match(re_sym, rest)
-            s = m.group(1)
-            tokens.append(Token("sym", s, lineno))
-            pos += len(s)
-        elif re.match(re_ident, rest):
-            m = re.match(re_ident, rest)
-            s = m.group(1)
+        elif kind == "space" or kind == "comment":
+            pass
+        elif kind == "ident":
+            s = m.group(kind)
             if is_kw(s):
-                tokens.append(Token("kw", s, lineno))
+                yield Token("kw", s, lineno)
             else:
-                tokens.append(Token("ident", s, lineno))
-            pos += len(s)
+                yield Token("ident", s, lineno)
         else:
-            raise not_yet_impl("rest", rest)
+            yield Token(kind, m.group(kind), lineno)
+
+def tokenize(src):
+    return list(iter_tokens(src))
 
-    return tokens
+def main():
+    src = read_stdin_all()
 
-src = read_stdin_all()
-tokens = tokenize(src)
+    for token in iter_tokens(src):
+        print(to_json(token))
 
-for token in tokens:
-    print(to_json(token))
+if __name__ == "__main__":
+    main()
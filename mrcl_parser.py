@@ -1,22 +1,24 @@
 import json, sys
 
 from lib.common import Token
-from lib.common import read_stdin_all, puts_e, inspect, p_e
+from lib.common import puts_e, inspect, p_e
 
-def read_tokens(src):
-    tokens = []
+# lines: JSON lines from mrcl_lexer (a str or e.g. sys.stdin)
+def read_tokens(lines):
+    if type(lines) == str:
+        lines = lines.split("\n")
 
-    for line in src.split("\n"):
-        if line != "":
+    for line in lines:
+        if line.strip() != "":
             parts = json.loads(line)
-            tokens.append(Token(parts[1], parts[2], parts[0]))
-
-    return tokens
+            yield Token(parts[1], parts[2], parts[0])
 
 # --------------------------------
 
-tokens = None
-pos = 0
+BINOPS = frozenset(["+", "*", "==", "!="])
+
+# consumed tokens kept by Parser before they are dropped
+TRIM_SIZE = 256
 
 def not_yet_impl(k, v):
     return Exception(f"{k} ({v})")
@@ -24,281 +26,312 @@ def not_yet_impl(k, v):
 def parse_error(val=None):
     return Exception("parse error " + inspect(val))
 
-def bump():
-    global pos
-    pos += 1
-
-def is_end():
-    return len(tokens) <= pos
-
-def peek(offset = 0):
-    global tokens
-    global pos
-
-    return tokens[pos + offset]
-
-def peek_and_next():
-    t = peek()
-    bump()
-    return t
-
-def rest_head():
-    return list(
-        map(lambda t: f"{t.kind}<{t.value}>", (
-            tokens[pos : pos + 8]
-        ))
-    )
-
-def dump_state(msg=""):
-    p_e([
-        msg, pos, rest_head()
-    ])
-
-def assert_value(pos, exp):
-    t = peek()
-
-    if t.value != exp:
-        msg = f"Assersion failed: expected({inspect(exp)}) actual({inspect(t)})"
-        raise Exception(msg)
-
-def consume(s):
-    assert_value(pos, s)
-    bump()
+# Holds all parse state, so that several sources can be parsed at the same
+# time (e.g. from threads).
+#
+# Tokens are read from the iterator only as far as the parser looks ahead,
+# and are kept in arrays indexed by position. Consumed tokens are dropped
+# from the arrays once there are TRIM_SIZE of them.
+class Parser:
+    __slots__ = ("token_iter", "tokens", "values", "pos", "num_trimmed")
+
+    def __init__(self, tokens):
+        self.token_iter = iter(tokens)
+        self.tokens = []
+        self.values = []
+        self.pos = 0 # index of the next token in the arrays
+        self.num_trimmed = 0
+
+    # reads tokens until the token at pos + offset is available
+    def fill(self, offset):
+        tokens = self.tokens
+
+        if self.pos >= TRIM_SIZE:
+            del tokens[:self.pos]
+            del self.values[:self.pos]
+            self.num_trimmed += self.pos
+            self.pos = 0
+
+        while len(tokens) <= self.pos + offset:
+            t = next(self.token_iter, None)
+            if t == None:
+                return False
+            tokens.append(t)
+            self.values.append(t.value)
+        return True
+
+    def peek(self, offset=0):
+        if self.pos + offset >= len(self.tokens) and not self.fill(offset):
+            raise IndexError("no more tokens")
+        return self.tokens[self.pos + offset]
+
+    def peek_value(self, offset=0):
+        if self.pos + offset >= len(self.values) and not self.fill(offset):
+            raise IndexError("no more tokens")
+        return self.values[self.pos + offset]
+
+    def bump(self):
+        self.peek()
+        self.pos += 1
+
+    def is_end(self):
+        return self.pos >= len(self.tokens) and not self.fill(0)
+
+    def peek_and_next(self):
+        t = self.peek()
+        self.pos += 1
+        return t
+
+    def rest_head(self):
+        self.fill(7)
+        return [
+            f"{t.kind}<{t.value}>"
+            for t in self.tokens[self.pos : self.pos + 8]
+        ]
+
+    def dump_state(self, msg=""):
+        p_e([
+            msg, self.num_trimmed + self.pos, self.rest_head()
+        ])
+
+    def consume(self, s):
+        if self.peek_value() != s:
+            t = self.peek()
+            msg = f"Assersion failed: expected({inspect(s)}) actual({inspect(t)})"
+            raise Exception(msg)
+        self.pos += 1
+
+    # --------------------------------
+
+    def _parse_arg(self):
+        return self.peek_and_next().get_value()
+
+    def parse_args(self):
+        args = []
+
+        if self.peek_value() == ")":
+            return args
+
+        args.append(self._parse_arg())
+
+        while self.peek_value() == ",":
+            self.consume(",")
+            args.append(self._parse_arg())
 
-# --------------------------------
-
-def _parse_arg():
-    t = peek_and_next()
-    return t.get_value()
-
-def parse_args():
-    args = []
-
-    if peek().value == ")":
         return args
 
-    args.append(_parse_arg())
-
-    while(peek().value == ","):
-        consume(",")
-        args.append(_parse_arg())
+    def parse_func(self):
+        self.consume("func")
+        func_name = self.peek_and_next().value
+        self.consume("(")
+        args = self.parse_args()
+        self.consume(")")
+        self.consume("{")
 
-    return args
+        stmts = []
+        while self.peek_value() != "}":
+            if self.peek_value() == "var":
+                stmts.append(self.parse_var())
+            else:
+                stmts.append(self.parse_stmt())
 
-def parse_func():
-    consume("func")
-    func_name = peek_and_next().value
-    consume("(")
-    args = parse_args()
-    consume(")")
-    consume("{")
+        self.consume("}")
 
-    stmts = []
-    while peek().value != "}":
-        if peek().value == "var":
-            stmts.append(parse_var())
-        else:
-            stmts.append(parse_stmt())
+        return ["func", func_name, args, stmts]
 
-    consume("}")
+    def _parse_var_declare(self):
+        var_name = self.peek_and_next().value
+        self.consume(";")
 
-    return ["func", func_name, args, stmts]
+        return ["var", var_name]
 
-def _parse_var_declare():
-    var_name = peek_and_next().value
-    consume(";")
+    def _parse_var_init(self):
+        var_name = self.peek_and_next().value
+        self.consume("=")
+        expr = self.parse_expr()
+        self.consume(";")
 
-    return ["var", var_name]
+        return ["var", var_name, expr]
 
-def _parse_var_init():
-    var_name = peek_and_next().value
-    consume("=")
-    expr = parse_expr()
-    consume(";")
+    def parse_var(self):
+        self.consume("var")
 
-    return ["var", var_name, expr]
+        t = self.peek(1)
+        if t.value == ";":
+            return self._parse_var_declare()
+        elif t.value == "=":
+            return self._parse_var_init()
+        else:
+            raise parse_error(f"unexpected token ({t})")
+
+    def _parse_expr_factor(self):
+        t = self.peek()
+        if t.kind == "int" or t.kind == "ident":
+            return self.peek_and_next().get_value()
+        elif t.kind == "sym":
+            self.consume("(")
+            expr = self.parse_expr()
+            self.consume(")")
+            return expr
+        else:
+            raise parse_error(f"unexpected token ({t})")
 
-def parse_var():
-    consume("var")
+    def parse_expr(self):
+        expr = self._parse_expr_factor()
 
-    t = peek(1)
-    if t.value == ";":
-        return _parse_var_declare()
-    elif t.value == "=":
-        return _parse_var_init()
-    else:
-        raise parse_error(f"unexpected token ({t})")
+        while self.peek_value() in BINOPS:
+            op = self.peek_and_next().value
+            factor = self._parse_expr_factor()
+            expr = [op, expr, factor]
 
-def _parse_expr_factor():
-    t = peek()
-    if t.kind == "int" or t.kind == "ident":
-        return peek_and_next().get_value()
-    elif t.kind == "sym":
-        consume("(")
-        expr = parse_expr()
-        consume(")")
         return expr
-    else:
-        raise parse_error(f"unexpected token ({t})")
-
-def is_binop(t):
-    return t.value in ["+", "*", "==", "!="]
 
-def parse_expr():
-    expr = _parse_expr_factor()
-
-    while(is_binop(peek())):
-        op = peek_and_next().value
-        factor = _parse_expr_factor()
-        expr = [op, expr, factor]
-
-    return expr
-
-
-def parse_set():
-    consume("set")
-    var_name = peek_and_next().value
-    consume("=")
-    expr = parse_expr()
-    consume(";")
-
-    return ["set", var_name, expr]
-
-def parse_funcall():
-    func_name = peek_and_next().value
-    consume("(")
-    args = parse_args()
-    consume(")")
-
-    return [func_name, *args]
-
-def parse_call():
-    consume("call")
-    funcall = parse_funcall()
-    consume(";")
-
-    return ["call", funcall]
-
-def parse_call_set():
-    consume("call_set")
-    var_name = peek_and_next().value
-    consume("=")
-    funcall = parse_funcall()
-    consume(";")
-
-    return ["call_set", var_name, funcall]
-
-def parse_return():
-    consume("return")
-    expr = parse_expr()
-    consume(";")
-
-    return ["return", expr]
-
-def parse_while():
-    consume("while")
-    consume("(")
-    expr = parse_expr()
-    consume(")")
-    consume("{")
-    stmts = parse_stmts()
-    consume("}")
-
-    return ["while", expr, stmts]
-
-def _parse_when_clause():
-    consume("when")
-    consume("(")
-    expr = parse_expr()
-    consume(")")
-    consume("{")
-    stmts = parse_stmts()
-    consume("}")
-
-    return [expr, *stmts]
-
-def parse_case():
-    consume("case")
-
-    when_clauses = []
-    while peek().value == "when":
-        when_clauses.append(_parse_when_clause())
-
-    return ["case", *when_clauses]
-
-def parse_vm_comment():
-    consume("_cmt")
-    consume("(")
-    comment = peek_and_next().value
-    consume(")")
-    consume(";")
-
-    return ["_cmt", comment]
-
-def parse_debug():
-    consume("_debug")
-    consume("(")
-    consume(")")
-    consume(";")
-
-    return ["_debug"]
-
-def parse_stmt():
-    t = peek()
-    if t.value == "set":
-        return parse_set()
-    elif t.value == "call":
-        return parse_call()
-    elif t.value == "call_set":
-        return parse_call_set()
-    elif t.value == "return":
-        return parse_return()
-    elif t.value == "while":
-        return parse_while()
-    elif t.value == "case":
-        return parse_case()
-    elif t.value == "_cmt":
-        return parse_vm_comment()
-    elif t.value == "_debug":
-        return parse_debug()
-    else:
-        raise Exception("parse error")
-
-def parse_stmts():
-    stmts = []
-    while peek().value != "}":
-        stmts.append(parse_stmt())
-
-    return stmts
-
-def parse_top_stmt():
-    if peek().value == "func":
-        return parse_func()
-    else:
-        raise Exception("unexpected token")
-
-def parse_top_stmts():
-    stmts = []
-    while not is_end():
-        stmts.append(parse_top_stmt())
-
-    return stmts
-
-def parse():
-    try:
-        stmts = parse_top_stmts()
-    except Exception as e:
-        dump_state()
-        raise e
-
-    return ["top_stmts", *stmts]
+    def parse_set(self):
+        self.consume("set")
+        var_name = self.peek_and_next().value
+        self.consume("=")
+        expr = self.parse_expr()
+        self.consume(";")
+
+        return ["set", var_name, expr]
+
+    def parse_funcall(self):
+        func_name = self.peek_and_next().value
+        self.consume("(")
+        args = self.parse_args()
+        self.consume(")")
+
+        return [func_name, *args]
+
+    def parse_call(self):
+        self.consume("call")
+        funcall = self.parse_funcall()
+        self.consume(";")
+
+        return ["call", funcall]
+
+    def parse_call_set(self):
+        self.consume("call_set")
+        var_name = self.peek_and_next().value
+        self.consume("=")
+        funcall = self.parse_funcall()
+        self.consume(";")
+
+        return ["call_set", var_name, funcall]
+
+    def parse_return(self):
+        self.consume("return")
+        expr = self.parse_expr()
+        self.consume(";")
+
+        return ["return", expr]
+
+    def parse_while(self):
+        self.consume("while")
+        self.consume("(")
+        expr = self.parse_expr()
+        self.consume(")")
+        self.consume("{")
+        stmts = self.parse_stmts()
+        self.consume("}")
+
+        return ["while", expr, stmts]
+
+    def _parse_when_clause(self):
+        self.consume("when")
+        self.consume("(")
+        expr = self.parse_expr()
+        self.consume(")")
+        self.consume("{")
+        stmts = self.parse_stmts()
+        self.consume("}")
+
+        return [expr, *stmts]
+
+    def parse_case(self):
+        self.consume("case")
+
+        when_clauses = []
+        while self.peek_value() == "when":
+            when_clauses.append(self._parse_when_clause())
+
+        return ["case", *when_clauses]
+
+    def parse_vm_comment(self):
+        self.consume("_cmt")
+        self.consume("(")
+        comment = self.peek_and_next().value
+        self.consume(")")
+        self.consume(";")
+
+        return ["_cmt", comment]
+
+    def parse_debug(self):
+        self.consume("_debug")
+        self.consume("(")
+        self.consume(")")
+        self.consume(";")
+
+        return ["_debug"]
+
+    def parse_stmt(self):
+        parse_fn = STMT_PARSERS.get(self.peek_value())
+        if parse_fn == None:
+            raise Exception("parse error")
+        return parse_fn(self)
+
+    def parse_stmts(self):
+        stmts = []
+        while self.peek_value() != "}":
+            stmts.append(self.parse_stmt())
+
+        return stmts
+
+    def parse_top_stmt(self):
+        if self.peek_value() == "func":
+            return self.parse_func()
+        else:
+            raise Exception("unexpected token")
+
+    def parse_top_stmts(self):
+        stmts = []
+        while not self.is_end():
+            stmts.append(self.parse_top_stmt())
+
+        return stmts
+
+    def parse(self):
+        try:
+            stmts = self.parse_top_stmts()
+        except Exception as e:
+            self.dump_state()
+            raise e
+
+        return ["top_stmts", *stmts]
+
+# statement keyword => method
+STMT_PARSERS = {
+    "set": Parser.parse_set,
+    "call": Parser.parse_call,
+    "call_set": Parser.parse_call_set,
+    "return": Parser.parse_return,
+    "while": Parser.parse_while,
+    "case": Parser.parse_case,
+    "_cmt": Parser.parse_vm_comment,
+    "_debug": Parser.parse_debug,
+}
+
+# tokens: list or iterator of Token
+def parse(tokens):
+    return Parser(tokens).parse()
 
 # --------------------------------
 
-src = read_stdin_all()
-tokens = read_tokens(src)
+def main():
+    tree = parse(read_tokens(sys.stdin))
 
-tree = parse()
+    print(json.dumps(tree, indent=2))
 
-print(json.dumps(tree, indent=2))
+if __name__ == "__main__":
+    main()
 
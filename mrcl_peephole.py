@@ -0,0 +1,225 @@
+import sys
+
+import mrcl_asm
+from mrcl_codegen import to_asm_src
+
+from lib.common import read_stdin_all, puts_e
+
+# Peephole optimizer for the assembly generated by mrcl_codegen.
+# Sits between mrcl_codegen and mrcl_asm:
+#
+#   ... | python3 mrcl_codegen.py | python3 mrcl_peephole.py | python3 mrcl_asm.py
+#
+# Note: values popped by a removed push/pop pair are not left below sp.
+
+def parse(src):
+    insns = []
+    for aline in mrcl_asm.parse(src):
+        insns.append(tuple(
+            int(x) if mrcl_asm.RE_INT.match(x) else x
+            for x in aline
+        ))
+    return insns
+
+def is_label(insn):
+    return insn[0] == "label"
+
+def count_label_refs(insns):
+    refs = {}
+    for insn in insns:
+        if insn[0] in ["jmp", "je", "call"]:
+            refs[insn[1]] = refs.get(insn[1], 0) + 1
+    return refs
+
+def uses_sp(operand):
+    return type(operand) == str and "sp" in operand
+
+# --------------------------------
+
+# add sp 0
+def remove_add_sp_zero(insns):
+    return [
+        insn for insn in insns
+        if insn != ("add", "sp", 0)
+    ]
+
+# push X / pop X => (none)
+# push X / pop Y => mov Y X
+# push R / mov D X / pop R => mov D X  (D is another register)
+def remove_push_pop(insns):
+    new_insns = []
+    i = 0
+    while i < len(insns):
+        insn = insns[i]
+        next_insn = insns[i + 1] if i + 1 < len(insns) else ()
+        next2_insn = insns[i + 2] if i + 2 < len(insns) else ()
+
+        if (
+            insn[0] == "push" and next_insn[:1] == ("pop",)
+            and not uses_sp(insn[1]) and not uses_sp(next_insn[1])
+        ):
+            if insn[1] != next_insn[1]:
+                new_insns.append(("mov", next_insn[1], insn[1]))
+            i += 2
+        elif (
+            insn[0] == "push" and insn[1] in ["reg_a", "reg_b"]
+            and next2_insn == ("pop", insn[1])
+            and next_insn[0] == "mov"
+            and next_insn[1] in ["reg_a", "reg_b"] and next_insn[1] != insn[1]
+            and not uses_sp(next_insn[2])
+        ):
+            new_insns.append(next_insn)
+            i += 3
+        else:
+            new_insns.append(insn)
+            i += 1
+
+    return new_insns
+
+# mov reg_a X / mov reg_b reg_a / pop reg_a => mov reg_b X / pop reg_a
+def forward_mov_reg_b(insns):
+    new_insns = []
+    i = 0
+    while i < len(insns):
+        window = insns[i : i + 3]
+
+        if (
+            len(window) == 3
+            and window[0][:2] == ("mov", "reg_a")
+            and window[1] == ("mov", "reg_b", "reg_a")
+            and window[2] == ("pop", "reg_a")
+            and window[0][2] != "reg_b"
+            and not uses_sp(window[0][2])
+        ):
+            new_insns.append(("mov", "reg_b", window[0][2]))
+            new_insns.append(window[2])
+            i += 3
+        else:
+            new_insns.append(insns[i])
+            i += 1
+
+    return new_insns
+
+# Conditions of while and case evaluate a 0/1 value and then compare it
+# with 0 again:
+#
+#     cmp                       cmp                   cmp
+#     je then_N                 je then_N             je then_N
+#     mov reg_a 0               mov reg_a 0           mov reg_a 1
+#     jmp end_eq_N     =>       jmp L                 jmp end_eq_N
+#   label then_N              label then_N          label then_N
+#     mov reg_a 1               mov reg_a 1           mov reg_a 0
+#   label end_eq_N              (for `==`)            jmp L
+#     mov reg_b 0                                   label end_eq_N
+#     cmp                                             (for `!=`)
+#     je L
+#
+# The 0/1 value is still left in reg_a on both exits, since a function
+# without return passes the last reg_a to its caller.
+def fuse_cmp_branch(insns):
+    refs = count_label_refs(insns)
+
+    new_insns = []
+    i = 0
+    while i < len(insns):
+        window = insns[i : i + 10]
+
+        if (
+            len(window) == 10
+            and window[0] == ("cmp",)
+            and window[1][0] == "je"
+            and window[2][:2] == ("mov", "reg_a") and window[2][2] in [0, 1]
+            and window[3][0] == "jmp"
+            and window[4] == ("label", window[1][1])
+            and window[5] == ("mov", "reg_a", 1 - window[2][2])
+            and window[6] == ("label", window[3][1])
+            and window[7] == ("mov", "reg_b", 0)
+            and window[8] == ("cmp",)
+            and window[9][0] == "je"
+            and refs.get(window[1][1]) == 1
+            and refs.get(window[3][1]) == 1
+        ):
+            label_then = window[1][1]
+            label_end = window[3][1]
+            label_dest = window[9][1]
+
+            if window[2][2] == 0:
+                # == : branch when not equal
+                new_insns.extend([
+                    ("cmp",),
+                    ("je", label_then),
+                    ("mov", "reg_a", 0),
+                    ("jmp", label_dest),
+                    ("label", label_then),
+                    ("mov", "reg_a", 1),
+                ])
+            else:
+                # != : branch when equal
+                new_insns.extend([
+                    ("cmp",),
+                    ("je", label_then),
+                    ("mov", "reg_a", 1),
+                    ("jmp", label_end),
+                    ("label", label_then),
+                    ("mov", "reg_a", 0),
+                    ("jmp", label_dest),
+                    ("label", label_end),
+                ])
+            i += 10
+        else:
+            new_insns.append(insns[i])
+            i += 1
+
+    return new_insns
+
+# jmp L / label ... / label L => label ... / label L
+def remove_jmp_to_next(insns):
+    new_insns = []
+    for i, insn in enumerate(insns):
+        if insn[0] == "jmp":
+            next_labels = []
+            j = i + 1
+            while j < len(insns) and is_label(insns[j]):
+                next_labels.append(insns[j][1])
+                j += 1
+            if insn[1] in next_labels:
+                continue
+
+        new_insns.append(insn)
+
+    return new_insns
+
+PASSES = [
+    remove_add_sp_zero,
+    remove_push_pop,
+    forward_mov_reg_b,
+    fuse_cmp_branch,
+    remove_jmp_to_next,
+]
+
+# Returns (optimized instructions, number of removed instructions).
+# Blank lines and comments are dropped.
+def optimize(insns):
+    insns = [insn for insn in insns if mrcl_asm.is_insn(insn)]
+    num_insns_before = len(insns)
+
+    while True:
+        num_insns = len(insns)
+        for pass_ in PASSES:
+            insns = pass_(insns)
+        if len(insns) == num_insns:
+            break
+
+    return (insns, num_insns_before - len(insns))
+
+# --------------------------------
+
+def main():
+    src = read_stdin_all()
+    insns, num_removed = optimize(parse(src))
+
+    sys.stdout.write(to_asm_src(insns))
+    puts_e(f"peephole: removed {num_removed} instructions")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import time
+
+from mrcl_vm import OPCODE_MAP
+
+# Runs a Vm while counting executions and wall time per address, per
+# opcode and per function. Vm.run() itself is not changed, so there is
+# no overhead when the profiler is not used.
+#
+# Functions are the targets of call instructions. The call stack is
+# tracked by call / ret, and each executed instruction is attributed to
+# the function on top of it.
+
+OP_CALL = OPCODE_MAP["call"]
+OP_RET  = OPCODE_MAP["ret"]
+
+ROOT_NAME = "(top)"
+
+# symbols: label => address (mrcl_asm.py --symbols)
+# Without symbols, the name of a call target is taken from the label
+# instruction just before it.
+def create_addr_name_map(insns, symbols=None):
+    if symbols != None:
+        return { addr: name for name, addr in symbols.items() }
+
+    addr_name_map = {}
+    for addr, insn in enumerate(insns):
+        if insn[0] == "label":
+            addr_name_map[addr + 1] = insn[1]
+    return addr_name_map
+
+class Profiler:
+    def __init__(self, vm, symbols=None):
+        self.vm = vm
+        self.addr_name_map = create_addr_name_map(vm.mem.main, symbols)
+
+        num_insns = len(vm.code)
+        self.addr_counts = [0] * num_insns
+        self.addr_times = [0.0] * num_insns
+        self.stack_counts = {} # (fn_name, ...) => number of steps
+        self.stack_times = {}  # (fn_name, ...) => sec
+        self.call_counts = {}  # fn_name => number of calls
+        self.total_time = 0.0
+
+    def fn_name(self, addr):
+        return self.addr_name_map.get(addr, f"addr_{addr}")
+
+    def run(self, max_steps=None):
+        vm = self.vm
+        code = vm.code
+        handlers = vm.handlers
+        addr_counts = self.addr_counts
+        addr_times = self.addr_times
+        stack_counts = self.stack_counts
+        stack_times = self.stack_times
+        call_counts = self.call_counts
+        perf_counter = time.perf_counter
+
+        call_stack = [ROOT_NAME]
+        stack_key = (ROOT_NAME,)
+        step_limit = None if max_steps is None else vm.step + max_steps
+        exited = False
+
+        t_start = perf_counter()
+        while step_limit is None or vm.step < step_limit:
+            vm.step += 1
+
+            pc = vm.pc
+            insn = code[pc]
+
+            t0 = perf_counter()
+            do_exit = handlers[insn[0]](insn)
+            dt = perf_counter() - t0
+
+            addr_counts[pc] += 1
+            addr_times[pc] += dt
+            stack_counts[stack_key] = stack_counts.get(stack_key, 0) + 1
+            stack_times[stack_key] = stack_times.get(stack_key, 0.0) + dt
+
+            if do_exit:
+                exited = True
+                break
+
+            op = insn[0]
+            if op == OP_CALL:
+                name = self.fn_name(insn[1])
+                call_counts[name] = call_counts.get(name, 0) + 1
+                call_stack.append(name)
+                stack_key = tuple(call_stack)
+            elif op == OP_RET and len(call_stack) > 1:
+                call_stack.pop()
+                stack_key = tuple(call_stack)
+
+        self.total_time += perf_counter() - t_start
+
+        return vm.get_state(exited)
+
+    # --------------------------------
+
+    def report_by_addr(self):
+        rows = []
+        for addr, count in enumerate(self.addr_counts):
+            if count > 0:
+                rows.append({
+                    "addr": addr,
+                    "insn": self.vm.mem.main[addr],
+                    "count": count,
+                    "time": self.addr_times[addr],
+                })
+        rows.sort(key=lambda row: (-row["count"], row["addr"]))
+        return rows
+
+    def report_by_opcode(self):
+        counts = {}
+        times = {}
+        for addr, count in enumerate(self.addr_counts):
+            if count > 0:
+                opcode = self.vm.mem.main[addr][0]
+                counts[opcode] = counts.get(opcode, 0) + count
+                times[opcode] = times.get(opcode, 0.0) + self.addr_times[addr]
+
+        rows = [
+            { "opcode": opcode, "count": count, "time": times[opcode] }
+            for opcode, count in counts.items()
+        ]
+        rows.sort(key=lambda row: (-row["count"], row["opcode"]))
+        return rows
+
+    def report_by_function(self):
+        self_counts = {}
+        self_times = {}
+        total_counts = {}
+        for stack_key, count in self.stack_counts.items():
+            name = stack_key[-1]
+            self_counts[name] = self_counts.get(name, 0) + count
+            self_times[name] = self_times.get(name, 0.0) + self.stack_times[stack_key]
+            # recursive calls are counted once per stack
+            for fn_name in set(stack_key):
+                total_counts[fn_name] = total_counts.get(fn_name, 0) + count
+
+        rows = [
+            {
+                "name": name,
+                "calls": self.call_counts.get(name, 0),
+                "self_count": self_counts.get(name, 0),
+                "total_count": total_count,
+                "self_time": self_times.get(name, 0.0),
+            }
+            for name, total_count in total_counts.items()
+        ]
+        rows.sort(key=lambda row: (-row["self_count"], row["name"]))
+        return rows
+
+    def report(self):
+        return {
+            "total_count": sum(self.addr_counts),
+            "total_time": self.total_time,
+            "by_function": self.report_by_function(),
+            "by_opcode": self.report_by_opcode(),
+            "by_addr": self.report_by_addr(),
+        }
+
+    # collapsed stack format for flame graph tools:
+    #   (top);main;make_next_gen 1234
+    def collapsed_stacks(self):
+        lines = []
+        for stack_key, count in sorted(self.stack_counts.items()):
+            lines.append(";".join(stack_key) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_collapsed_stacks(self, path):
+        with open(path, "w") as f:
+            f.write(self.collapsed_stacks())
@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import signal
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import mrcl_asm
+import mrcl_exe
+import mrcl_compiler
+import mrcl_batch
+
+from lib.common import puts_e
+
+# Compile / assemble / run server with the toolchain loaded once.
+#
+#   python3 mrcl_server.py serve [--socket PATH] [--workers N]
+#   python3 mrcl_server.py call run '{"src": "func main() { ... }"}'
+#
+# Protocol: JSON-RPC 2.0 over a Unix socket, one JSON object per line.
+# Requests on a connection are handled concurrently on a process pool,
+# so responses may come back in a different order (match them by id).
+#
+# methods:
+#   compile   { src, emit?: tokens|tree|asm|exe, binary?, fold?, reg_b_leaf?,
+#               peephole?, inline_vram? }
+#             => { tokens } | { tree } | { asm } | { insns, symbols }
+#                (binary: { exe: base64 of the binary executable, symbols })
+#   assemble  { asm } => { insns, symbols }
+#   run       { insns | asm | src (+ compile options),
+#               max_steps?, timeout?, engine?, vram?, stack?,
+#               vram_width?, vram_height?, vram_pages? }
+#             => { status, state }
+#             (max_steps and timeout are capped by the server's limits)
+#   ping      {} => "pong"
+
+DEFAULT_SOCKET = "/tmp/mrcl_server.sock"
+
+# max size of a request line
+MAX_LINE_BYTES = 64 * 1024 * 1024
+
+# default limits of a run request
+DEFAULT_MAX_STEPS = 100_000_000
+DEFAULT_TIMEOUT = 60 # sec
+
+# max VRAM size of a run request (width x height x pages)
+MAX_VRAM_CELLS = 16 * 1024 * 1024
+
+ERR_PARSE            = -32700
+ERR_INVALID_REQUEST  = -32600
+ERR_METHOD_NOT_FOUND = -32601
+ERR_INVALID_PARAMS   = -32602
+ERR_SERVER           = -32000
+
+COMPILE_OPTIONS = ["fold", "reg_b_leaf", "peephole", "inline_vram"]
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def get_param(params, name):
+    if name not in params:
+        raise RpcError(ERR_INVALID_PARAMS, f"missing param ({name})")
+    return params[name]
+
+def get_compile_options(params):
+    return { name: params[name] for name in COMPILE_OPTIONS if name in params }
+
+# => params with max_steps and timeout not above the limits
+def apply_run_limits(params, max_steps, timeout):
+    params = dict(params)
+    for name, limit in [("max_steps", max_steps), ("timeout", timeout)]:
+        value = params.get(name)
+        if value == None:
+            params[name] = limit
+        elif type(value) not in [int, float]:
+            raise RpcError(ERR_INVALID_PARAMS, f"{name} must be a number")
+        elif value > limit:
+            params[name] = limit
+    return params
+
+# --------------------------------
+# methods (run in worker processes)
+
+def rpc_compile(params):
+    src = get_param(params, "src")
+    emit = params.get("emit", "exe")
+    if emit not in mrcl_compiler.STAGES:
+        raise RpcError(ERR_INVALID_PARAMS, f"invalid emit ({emit})")
+
+    result = mrcl_compiler.compile_to(src, emit, **get_compile_options(params))
+
+    if emit == "tokens":
+        return { "tokens": [[t.lineno, t.kind, t.value] for t in result] }
+    elif emit == "tree":
+        return { "tree": result }
+    elif emit == "asm":
+        return { "asm": result }
+
+    insns, symbols = result
+    if params.get("binary", False):
+        exe = base64.b64encode(mrcl_exe.dump(insns)).decode("ascii")
+        return { "exe": exe, "symbols": symbols }
+    return { "insns": insns, "symbols": symbols }
+
+def rpc_assemble(params):
+    asm_src = get_param(params, "asm")
+    insns, symbols = mrcl_asm.assemble_with_symbols(asm_src.split("\n"))
+    return { "insns": insns, "symbols": symbols }
+
+def rpc_run(params):
+    t0 = time.monotonic()
+
+    if "insns" in params:
+        insns = params["insns"]
+    elif "asm" in params:
+        insns = mrcl_asm.assemble(params["asm"].split("\n"))
+    elif "src" in params:
+        insns, _ = mrcl_compiler.compile_to(
+            params["src"], "exe", **get_compile_options(params)
+        )
+    else:
+        raise RpcError(ERR_INVALID_PARAMS, "one of insns, asm or src is required")
+
+    geometry = mrcl_batch.get_vram_geometry(params)
+    num_cells = 1
+    for key, size in geometry.items():
+        if type(size) != int or size < 1:
+            raise RpcError(ERR_INVALID_PARAMS, f"{key} must be a positive integer")
+        num_cells *= size
+    if num_cells > MAX_VRAM_CELLS:
+        raise RpcError(ERR_INVALID_PARAMS, f"VRAM too large ({num_cells} > {MAX_VRAM_CELLS})")
+
+    vm = mrcl_batch.create_vm(params.get("engine", "interp"), **geometry)
+    vm.load_program(insns)
+    if params.get("vram") != None:
+        mrcl_batch.apply_image(vm.mem.vram, params["vram"], "vram")
+    if params.get("stack") != None:
+        mrcl_batch.apply_image(vm.mem.stack, params["stack"], "stack")
+
+    timeout = params.get("timeout")
+    deadline = None if timeout is None else t0 + timeout
+    status, state = mrcl_batch.run_vm(vm, params.get("max_steps"), deadline)
+    return { "status": status, "state": state }
+
+def rpc_ping(params):
+    return "pong"
+
+METHODS = {
+    "compile": rpc_compile,
+    "assemble": rpc_assemble,
+    "run": rpc_run,
+    "ping": rpc_ping,
+}
+
+# => ("result", value) or ("error", { code, message })
+def call_method(method, params):
+    try:
+        return ("result", METHODS[method](params))
+    except RpcError as e:
+        return ("error", { "code": e.code, "message": str(e) })
+    except Exception as e:
+        return ("error", { "code": ERR_SERVER, "message": str(e) })
+
+# --------------------------------
+# server
+
+def error_response(id_, code, message):
+    return {
+        "jsonrpc": "2.0",
+        "id": id_,
+        "error": { "code": code, "message": message },
+    }
+
+class Server:
+    def __init__(
+        self, socket_path, workers=None,
+        max_steps=DEFAULT_MAX_STEPS, timeout=DEFAULT_TIMEOUT
+    ):
+        self.socket_path = socket_path
+        self.workers = workers
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    async def call_in_worker(self, method, params):
+        executor = self.executor
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                executor, call_method, method, params
+            )
+        except BrokenProcessPool:
+            # a worker died (killed, out of memory, ...); the pool cannot
+            # be used any more, so replace it once for all waiting requests
+            if self.executor is executor:
+                puts_e("worker process died, restarting the pool")
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                executor.shutdown(wait=False)
+            return ("error", { "code": ERR_SERVER, "message": "worker process died" })
+        except Exception as e:
+            return ("error", { "code": ERR_SERVER, "message": str(e) })
+
+    async def handle_request(self, line):
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            return error_response(None, ERR_PARSE, f"parse error ({e})")
+
+        if type(req) != dict or type(req.get("method")) != str:
+            return error_response(None, ERR_INVALID_REQUEST, "invalid request")
+
+        id_ = req.get("id")
+        method = req["method"]
+        params = req.get("params", {})
+
+        if method not in METHODS:
+            return error_response(id_, ERR_METHOD_NOT_FOUND, f"method not found ({method})")
+        if type(params) != dict:
+            return error_response(id_, ERR_INVALID_PARAMS, "params must be an object")
+
+        if method == "run":
+            try:
+                params = apply_run_limits(params, self.max_steps, self.timeout)
+            except RpcError as e:
+                return error_response(id_, e.code, str(e))
+
+        kind, value = await self.call_in_worker(method, params)
+        return { "jsonrpc": "2.0", "id": id_, kind: value }
+
+    async def respond(self, line, writer, write_lock):
+        try:
+            res = await self.handle_request(line)
+        except Exception as e:
+            res = error_response(None, ERR_SERVER, str(e))
+        data = (json.dumps(res) + "\n").encode("utf-8")
+        async with write_lock:
+            writer.write(data)
+            await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # line too long
+                    res = error_response(None, ERR_INVALID_REQUEST, "request too large")
+                    writer.write((json.dumps(res) + "\n").encode("utf-8"))
+                    break
+                if not line:
+                    break
+                if line.strip() == b"":
+                    continue
+
+                task = asyncio.create_task(self.respond(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        server = await asyncio.start_unix_server(
+            self.handle_client, path=self.socket_path, limit=MAX_LINE_BYTES
+        )
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        puts_e(f"listening on {self.socket_path}")
+        async with server:
+            await stop.wait()
+
+        os.unlink(self.socket_path)
+        self.executor.shutdown()
+
+# --------------------------------
+# client
+
+def call(method, params=None, socket_path=DEFAULT_SOCKET):
+    req = { "jsonrpc": "2.0", "id": 1, "method": method, "params": params or {} }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            f.write((json.dumps(req) + "\n").encode("utf-8"))
+            f.flush()
+            res = json.loads(f.readline())
+
+    if "error" in res:
+        raise Exception(res["error"]["message"])
+    return res["result"]
+
+# --------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_serve = subparsers.add_parser("serve")
+    parser_serve.add_argument(
+        "--workers", type=int, default=None,
+        help="number of worker processes (default: number of CPUs)"
+    )
+    parser_serve.add_argument(
+        "--max-steps", type=int, default=DEFAULT_MAX_STEPS,
+        help="max steps of a run request"
+    )
+    parser_serve.add_argument(
+        "--timeout", type=float, default=DEFAULT_TIMEOUT,
+        help="max seconds of a run request"
+    )
+
+    parser_call = subparsers.add_parser("call")
+    parser_call.add_argument("method", choices=list(METHODS.keys()))
+    parser_call.add_argument(
+        "params", nargs="?", default="{}",
+        help="params as a JSON object"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.command == "serve":
+        server = Server(
+            args.socket, args.workers,
+            max_steps=args.max_steps, timeout=args.timeout
+        )
+        asyncio.run(server.serve())
+    else:
+        result = call(args.method, json.loads(args.params), args.socket)
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
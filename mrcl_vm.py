@@ -1,21 +1,50 @@
+import argparse
+from array import array
 import json
 import os
-import re
 import sys
 
+import mrcl_exe
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from lib.common import file_read, p_e, puts_e
 
 COLOR_RESET = "\033[m"
 COLOR_RED   = "\033[0;31m"
 COLOR_BLUE  = "\033[0;34m"
 
+# stack and VRAM are arrays of signed 64 bit ints
+#
+# VRAM consists of pages of width x height cells; dump_vram() shows the
+# first page.
 class Memory:
+    __slots__ = (
+        "main", "stack", "vram",
+        "vram_width", "vram_height", "vram_prev",
+    )
+
     MAIN_DUMP_WIDTH = 10
 
-    def __init__(self, stack_size):
+    DEFAULT_VRAM_WIDTH = 5
+    DEFAULT_VRAM_HEIGHT = 5
+    DEFAULT_VRAM_PAGES = 2
+
+    def __init__(
+        self, stack_size,
+        vram_width=DEFAULT_VRAM_WIDTH,
+        vram_height=DEFAULT_VRAM_HEIGHT,
+        vram_pages=DEFAULT_VRAM_PAGES
+    ):
         self.main = []
-        self.stack = [0] * stack_size
-        self.vram = [0] * 50
+        self.stack = array("q", [0]) * stack_size
+        self.vram = array("q", [0]) * (vram_width * vram_height * vram_pages)
+        self.vram_width = vram_width
+        self.vram_height = vram_height
+        self.vram_prev = None # first page at the last dump_vram_diff()
 
     def dump_main(self, pc):
         work_insns = []
@@ -86,31 +115,152 @@ class Memory:
 
         return "\n".join(lines)
 
-    def dump_vram(self):
-        lines = []
-        y = 0
-        while y < 5:
-            x = 0
-            cols = []
-            while x < 5:
-                i = y * 5 + x
-                val = self.vram[i]
-                if val == 1:
-                    cols.append("@")
-                else:
-                    cols.append(".")
-                x += 1
-            lines.append("".join(cols))
-            y += 1
+    # => ["..@..", ...]
+    def render_vram_rows(self, ys):
+        w = self.vram_width
+
+        if np != None:
+            cells = np.frombuffer(
+                self.vram, dtype=np.int64, count=w * self.vram_height
+            ).reshape(-1, w)
+            chars = np.where(cells[list(ys)] == 1, ord("@"), ord("."))
+            return [
+                row.tobytes().decode("ascii")
+                for row in chars.astype(np.uint8)
+            ]
+
+        vram = self.vram
+        return [
+            "".join(["@" if val == 1 else "." for val in vram[y * w : (y + 1) * w]])
+            for y in ys
+        ]
 
-        return "\n".join(lines)
+    def dump_vram(self):
+        return "\n".join(self.render_vram_rows(range(self.vram_height)))
+
+    # rows of the first page changed since the last call (all rows at first)
+    def changed_vram_rows(self):
+        w = self.vram_width
+        h = self.vram_height
+        page = self.vram[: w * h]
+        prev = self.vram_prev
+        self.vram_prev = page
+
+        if prev is None:
+            return list(range(h))
+        elif np != None:
+            diff = np.frombuffer(page, dtype=np.int64) != np.frombuffer(prev, dtype=np.int64)
+            return np.flatnonzero(diff.reshape(h, w).any(axis=1)).tolist()
+        else:
+            return [
+                y for y in range(h)
+                if page[y * w : (y + 1) * w] != prev[y * w : (y + 1) * w]
+            ]
+
+    # Renders only the rows changed since the last call:
+    #   <y> <row>
+    def dump_vram_diff(self):
+        ys = self.changed_vram_rows()
+        rows = self.render_vram_rows(ys)
+        return "\n".join(f"{y} {row}" for y, row in zip(ys, rows))
+
+# opcodes
+OPCODES = [
+    "exit", "mov", "add", "mul", "cmp", "label", "jmp", "je", "call", "ret",
+    "push", "pop", "set_vram", "get_vram", "_cmt",
+    "copy_vram", "fill_vram",
+]
+OPCODE_MAP = { name: i for i, name in enumerate(OPCODES) }
+OP_UNKNOWN = len(OPCODES)
+
+# operand kinds
+OPND_INT     = 0
+OPND_REG_A   = 1
+OPND_REG_B   = 2
+OPND_BP      = 3
+OPND_SP      = 4
+OPND_MEM     = 5 # (OPND_MEM, base register operand, disp)
+OPND_INVALID = 6 # (OPND_INVALID, original arg, None)
+
+REG_KINDS = {
+    "reg_a": OPND_REG_A,
+    "reg_b": OPND_REG_B,
+    "bp": OPND_BP,
+    "sp": OPND_SP,
+}
+
+def decode_operand(arg):
+    if type(arg) == int:
+        return (OPND_INT, arg, None)
+    elif type(arg) == str:
+        if arg in REG_KINDS:
+            return (REG_KINDS[arg], arg, None)
+        elif arg.startswith("mem:"):
+            _, base_str, disp_str = arg.split(":")
+            base = decode_operand(base_str)
+            if base[0] == OPND_INVALID:
+                return base
+            return (OPND_MEM, base, int(disp_str))
+
+    return (OPND_INVALID, arg, None)
+
+# operand_cache: (type, arg) => decoded operand, shared by the
+# instructions of one program (the type keeps e.g. 1 and True apart)
+def decode_operand_cached(arg, operand_cache):
+    key = (type(arg), arg)
+    try:
+        return operand_cache[key]
+    except KeyError:
+        opnd = operand_cache[key] = decode_operand(arg)
+        return opnd
+
+# ["mov", "reg_a", "mem:bp:-1"] => (OP_MOV, (OPND_REG_A, ...), (OPND_MEM, ...))
+# jump addresses, label names and comments are kept as is
+def decode_insn(insn, operand_cache):
+    opcode = insn[0]
+    op = OPCODE_MAP.get(opcode, OP_UNKNOWN)
+
+    if op == OP_UNKNOWN:
+        return (op, opcode)
+    elif opcode in ["jmp", "je", "call", "label", "_cmt"]:
+        return (op, *insn[1:])
+    else:
+        return (op, *[decode_operand_cached(arg, operand_cache) for arg in insn[1:]])
+
+def decode_program(insns):
+    operand_cache = {}
+    return [decode_insn(insn, operand_cache) for insn in insns]
+
+# block operations on VRAM
+# (slice assignment would resize the array if a range went past the end)
+
+def check_vram_range(vram, addr, n):
+    if n < 0 or addr < 0 or addr + n > len(vram):
+        raise Exception(f"vram range out of bounds (addr {addr}, size {n})")
+
+def copy_vram(vram, dest, src, n):
+    check_vram_range(vram, dest, n)
+    check_vram_range(vram, src, n)
+    vram[dest : dest + n] = vram[src : src + n]
+
+def fill_vram(vram, addr, n, val):
+    check_vram_range(vram, addr, n)
+    vram[addr : addr + n] = array("q", [val]) * n
 
 class Vm:
+    __slots__ = (
+        "mem", "code", "stack_size",
+        "pc", "reg_a", "reg_b", "zf", "sp", "bp",
+        "step", "debug", "vram_diff", "handlers",
+    )
+
     FLAG_TRUE = 1
     FLAG_FALSE = 0
 
     def __init__(self, mem, stack_size):
         self.mem = mem
+        self.code = []
+        self.stack_size = stack_size
 
         self.pc = 0
         self.reg_a = 0
@@ -120,6 +270,12 @@ class Vm:
         self.bp = stack_size - 1
         self.step = 0
         self.debug = False
+        self.vram_diff = False
+
+        self.handlers = [
+            getattr(self, "insn_" + opcode) for opcode in OPCODES
+        ]
+        self.handlers.append(self.insn_unknown)
 
     # TODO
     #   def test?
@@ -129,10 +285,16 @@ class Vm:
     def set_sp(self, addr):
         if addr < 0:
             raise Exception("stack overflow")
+        elif addr > self.stack_size - 1:
+            raise Exception("stack underflow")
 
         self.sp = addr
 
     def load_program_file(self, path):
+        if mrcl_exe.is_binary(path):
+            self.load_program(mrcl_exe.load(path))
+            return
+
         src = file_read(path)
         lines = src.split("\n")
         insns = []
@@ -143,57 +305,12 @@ class Vm:
 
     def load_program(self, insns):
         self.mem.main = insns
+        self.code = decode_program(insns)
 
     def execute(self):
-        insn = self.mem.main[self.pc]
-        opcode = insn[0]
-
-        if opcode == "exit":
-            return True
-        elif opcode == "mov":
-            self.insn_mov()
-            self.pc += 1
-        elif opcode == "add":
-            self.insn_add()
-            self.pc += 1
-        elif opcode == "mul":
-            self.insn_mul()
-            self.pc += 1
-        elif opcode == "cmp":
-            self.insn_cmp()
-            self.pc += 1
-        elif opcode == "label":
-            self.pc += 1
-        elif opcode == "jmp":
-            self.insn_jmp()
-        elif opcode == "je":
-            self.insn_je()
-        elif opcode == "call":
-            self.insn_call()
-        elif opcode == "ret":
-            self.insn_ret()
-        elif opcode == "push":
-            self.insn_push()
-            self.pc += 1
-        elif opcode == "pop":
-            self.insn_pop()
-            self.pc += 1
-        elif opcode == "set_vram":
-            self.insn_set_vram()
-            self.pc += 1
-        elif opcode == "get_vram":
-            self.insn_get_vram()
-            self.pc += 1
-        elif opcode == "_cmt":
-            self.pc += 1
-
-        # TODO
-        #     when "_debug"   then insn__debug()   ; @pc += 1
-
-        else:
-            raise Exception(f"unknown opcode ({opcode})")
-
-        return False
+        insn = self.code[self.pc]
+        do_exit = self.handlers[insn[0]](insn)
+        return do_exit == True
 
     def start(self):
         # TODO if not test?
@@ -217,6 +334,36 @@ class Vm:
                     self.dump()
             # end if
 
+    # Runs without prompts and dumps. Stops after max_steps steps if given.
+    def run(self, max_steps=None):
+        code = self.code
+        handlers = self.handlers
+        step_limit = None if max_steps is None else self.step + max_steps
+
+        while step_limit is None or self.step < step_limit:
+            self.step += 1
+
+            insn = code[self.pc]
+            do_exit = handlers[insn[0]](insn)
+            if do_exit:
+                return self.get_state(True)
+
+        return self.get_state(False)
+
+    def get_state(self, exited):
+        return {
+            "exited": exited,
+            "step": self.step,
+            "pc": self.pc,
+            "reg_a": self.reg_a,
+            "reg_b": self.reg_b,
+            "zf": self.zf,
+            "sp": self.sp,
+            "bp": self.bp,
+            "stack": list(self.mem.stack),
+            "vram": list(self.mem.vram),
+        }
+
     def dump_reg(self):
         return f"reg_a({self.reg_a}) reg_b({self.reg_b})"
 
@@ -229,157 +376,296 @@ class Vm:
 ---- memory (stack) ----
 {self.mem.dump_stack(self.sp, self.bp)}
 ---- memory (vram) ----
-{self.mem.dump_vram()}
+{self.dump_vram()}
         """)
 
-    def is_mem_ref(self, arg):
-        return re.match(r"mem:", arg)
-
-    def calc_indirect_addr(self, mem_str):
-        _, base_str, disp_str = mem_str.split(":")
-        base = self.get_val(base_str)
-        return base + int(disp_str)
-
-    def get_val(self, arg):
-        if type(arg) == int:
-            return arg
-        elif type(arg) == str:
-            if arg == "reg_a":
-                return self.reg_a
-            elif arg == "reg_b":
-                return self.reg_b
-            elif arg == "bp":
-                return self.bp
-            elif arg == "sp":
-                return self.sp
-            elif self.is_mem_ref(arg):
-                addr = self.calc_indirect_addr(arg)
-                return self.mem.stack[addr]
-            else:
-                raise Exception(f"unsupported ({arg})")
+    def dump_vram(self):
+        if self.vram_diff:
+            return self.mem.dump_vram_diff()
         else:
-            raise Exception(f"unsupported ({arg})")
+            return self.mem.dump_vram()
 
-    def set_val(self, dest, val):
-        if dest == "reg_a":
+    def calc_indirect_addr(self, opnd):
+        _, base_opnd, disp = opnd
+        if base_opnd[0] == OPND_BP:
+            return self.bp + disp
+        else:
+            return self.get_val(base_opnd) + disp
+
+    def get_val(self, opnd):
+        kind = opnd[0]
+
+        if kind == OPND_MEM:
+            addr = self.calc_indirect_addr(opnd)
+            return self.mem.stack[addr]
+        elif kind == OPND_INT:
+            return opnd[1]
+        elif kind == OPND_REG_A:
+            return self.reg_a
+        elif kind == OPND_REG_B:
+            return self.reg_b
+        elif kind == OPND_BP:
+            return self.bp
+        elif kind == OPND_SP:
+            return self.sp
+        else:
+            raise Exception(f"unsupported ({opnd[1]})")
+
+    def set_val(self, opnd, val):
+        kind = opnd[0]
+
+        if kind == OPND_REG_A:
             self.reg_a = val
-        elif dest == "reg_b":
+        elif kind == OPND_REG_B:
             self.reg_b = val
-        elif dest == "bp":
+        elif kind == OPND_MEM:
+            addr = self.calc_indirect_addr(opnd)
+            self.mem.stack[addr] = val
+        elif kind == OPND_BP:
             self.bp = val
-        elif dest == "sp":
+        elif kind == OPND_SP:
             self.set_sp(val)
-        elif self.is_mem_ref(dest):
-            addr = self.calc_indirect_addr(dest)
-            self.mem.stack[addr] = val
         else:
-            raise Exception(f"unsupported ({dest})")
+            raise Exception(f"unsupported ({opnd[1]})")
+
+    def insn_exit(self, insn):
+        return True
 
-    def insn_add(self):
-        arg_dest = self.mem.main[self.pc][1]
-        arg_src = self.mem.main[self.pc][2]
+    def insn_add(self, insn):
+        arg_dest = insn[1]
+        arg_src = insn[2]
 
         dest_val = self.get_val(arg_dest)
         src_val = self.get_val(arg_src)
 
         self.set_val(arg_dest, dest_val + src_val)
+        self.pc += 1
 
-    def insn_mul(self):
-        arg_src = self.mem.main[self.pc][1]
+    def insn_mul(self, insn):
+        arg_src = insn[1]
 
         dest_val = self.reg_a
         src_val = self.get_val(arg_src)
 
-        self.set_val("reg_a", dest_val * src_val)
+        self.reg_a = dest_val * src_val
+        self.pc += 1
 
-    def insn_mov(self):
-        arg_dest = self.mem.main[self.pc][1]
-        arg_src  = self.mem.main[self.pc][2]
+    def insn_mov(self, insn):
+        arg_dest = insn[1]
+        arg_src  = insn[2]
 
         src_val = self.get_val(arg_src)
         self.set_val(arg_dest, src_val)
-    def insn_cmp(self):
+        self.pc += 1
+
+    def insn_cmp(self, insn):
         if self.reg_a == self.reg_b:
             self.zf = self.FLAG_TRUE
         else:
             self.zf = self.FLAG_FALSE
+        self.pc += 1
+
+    def insn_label(self, insn):
+        self.pc += 1
 
-    def insn_jmp(self):
-        jump_dest = self.mem.main[self.pc][1]
+    def insn_jmp(self, insn):
+        jump_dest = insn[1]
         self.pc = jump_dest
 
-    def insn_je(self):
+    def insn_je(self, insn):
         if self.zf == self.FLAG_TRUE:
-            jump_dest = self.mem.main[self.pc][1]
+            jump_dest = insn[1]
             self.pc = jump_dest
         else:
             self.pc += 1
 
-    def insn_call(self):
+    def insn_call(self, insn):
         self.set_sp(self.sp - 1)
         self.mem.stack[self.sp] = self.pc + 1
-        next_addr = self.mem.main[self.pc][1]
+        next_addr = insn[1]
         self.pc = next_addr
 
-    def insn_ret(self):
+    def insn_ret(self, insn):
         ret_addr = self.mem.stack[self.sp]
         self.pc = ret_addr
         self.set_sp(self.sp + 1)
 
-    def insn_push(self):
-        arg = self.mem.main[self.pc][1]
+    def insn_push(self, insn):
+        arg = insn[1]
 
         val_to_push = self.get_val(arg)
 
         self.set_sp(self.sp - 1)
         self.mem.stack[self.sp] = val_to_push
+        self.pc += 1
 
-    def insn_pop(self):
-        arg = self.mem.main[self.pc][1]
+    def insn_pop(self, insn):
+        arg = insn[1]
         val = self.mem.stack[self.sp]
 
         self.set_val(arg, val)
 
         self.set_sp(self.sp + 1)
+        self.pc += 1
 
-    def insn_set_vram(self):
-        arg_vram = self.mem.main[self.pc][1]
-        arg_val = self.mem.main[self.pc][2]
+    def insn_set_vram(self, insn):
+        arg_vram = insn[1]
+        arg_val = insn[2]
 
+        # an int operand is the address itself
+        vram_addr = self.get_val(arg_vram)
         src_val = self.get_val(arg_val)
 
-        if type(arg_vram) == int:
-            self.mem.vram[arg_vram] = src_val
-        elif self.is_mem_ref(arg_vram):
-            stack_addr = self.calc_indirect_addr(arg_vram)
-            vram_addr = self.mem.stack[stack_addr]
-            self.mem.vram[vram_addr] = src_val
-        else:
-          raise Exception(f"unsupported ({arg_vram})")
+        self.mem.vram[vram_addr] = src_val
+        self.pc += 1
 
-    def insn_get_vram(self):
-        arg_vram = self.mem.main[self.pc][1]
-        arg_dest = self.mem.main[self.pc][2]
+    def insn_get_vram(self, insn):
+        arg_vram = insn[1]
+        arg_dest = insn[2]
 
         vram_addr = self.get_val(arg_vram)
         val = self.mem.vram[vram_addr]
 
         self.set_val(arg_dest, val)
+        self.pc += 1
+
+    def insn_copy_vram(self, insn):
+        dest = self.get_val(insn[1])
+        src = self.get_val(insn[2])
+        n = self.get_val(insn[3])
+
+        copy_vram(self.mem.vram, dest, src, n)
+        self.pc += 1
+
+    def insn_fill_vram(self, insn):
+        addr = self.get_val(insn[1])
+        n = self.get_val(insn[2])
+        val = self.get_val(insn[3])
+
+        fill_vram(self.mem.vram, addr, n, val)
+        self.pc += 1
+
+    def insn__cmt(self, insn):
+        self.pc += 1
+
+    def insn_unknown(self, insn):
+        raise Exception(f"unknown opcode ({insn[1]})")
 
     # TODO
     #   def insn__debug
     #     @debug = true
     #   end
 
-if __name__ == "__main__":
-    exe_file = sys.argv[1]
-    print(exe_file)
-
-    stack_size = 50
-    mem = Memory(stack_size)
-    vm = Vm(mem, stack_size)
-    vm.load_program_file(exe_file)
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("exe_file", nargs="?")
+    parser.add_argument(
+        "--interactive", action="store_true",
+        help="prompt before start and dump state while running (also enabled by STEP=)"
+    )
+    parser.add_argument(
+        "--max-steps", type=int, default=None,
+        help="stop after this many steps (headless mode)"
+    )
+    parser.add_argument(
+        "--engine", choices=["interp", "jit"], default="interp",
+        help="interp: decode and dispatch each instruction / jit: translate the program into Python functions (headless mode)"
+    )
+    parser.add_argument(
+        "--profile", metavar="FILE",
+        help="profile the run and write the report as JSON (headless mode)"
+    )
+    parser.add_argument(
+        "--profile-collapsed", metavar="FILE",
+        help="profile the run and write collapsed stacks for flame graphs (headless mode)"
+    )
+    parser.add_argument(
+        "--symbols", metavar="FILE",
+        help="symbol table from mrcl_asm.py --symbols, used to name functions in profiles"
+    )
+    parser.add_argument("--vram-width", type=int, default=Memory.DEFAULT_VRAM_WIDTH)
+    parser.add_argument("--vram-height", type=int, default=Memory.DEFAULT_VRAM_HEIGHT)
+    parser.add_argument(
+        "--vram-pages", type=int, default=Memory.DEFAULT_VRAM_PAGES,
+        help="number of width x height pages (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--vram-diff", action="store_true",
+        help="show only the VRAM rows changed since the last dump (interactive mode)"
+    )
+    parser.add_argument(
+        "--checkpoint", metavar="FILE",
+        help="save the machine state to FILE periodically and at the end (headless mode)"
+    )
+    parser.add_argument(
+        "--checkpoint-every", type=int, default=100_000, metavar="N",
+        help="checkpoint interval in steps (default: 100000)"
+    )
+    parser.add_argument(
+        "--resume", metavar="FILE",
+        help="restore the machine state from a checkpoint instead of loading exe_file"
+    )
+    args = parser.parse_args(argv)
+
+    if args.exe_file is None and args.resume is None:
+        parser.error("exe_file or --resume is required")
+    if args.checkpoint_every <= 0:
+        parser.error("--checkpoint-every must be positive")
+
+    # the profiler steps the interpreter itself and does not checkpoint
+    profile = args.profile != None or args.profile_collapsed != None
+    if profile and args.engine == "jit":
+        parser.error("--profile and --profile-collapsed cannot be used with --engine jit")
+    if profile and args.checkpoint != None:
+        parser.error("--profile and --profile-collapsed cannot be used with --checkpoint")
+
+    return args
 
-    vm.start()
-    vm.dump()
-    puts_e("exit")
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    interactive = args.interactive or os.getenv("STEP") != None
+
+    if args.engine == "jit":
+        from mrcl_jit import JitVm
+        vm_class = JitVm
+    else:
+        vm_class = Vm
+
+    if args.resume != None:
+        import mrcl_checkpoint
+        vm = mrcl_checkpoint.load(args.resume, vm_class)
+    else:
+        stack_size = 50
+        mem = Memory(stack_size, args.vram_width, args.vram_height, args.vram_pages)
+        vm = vm_class(mem, stack_size)
+        vm.load_program_file(args.exe_file)
+    vm.vram_diff = args.vram_diff
+
+    if interactive:
+        print(args.exe_file or args.resume)
+        vm.start()
+        vm.dump()
+        puts_e("exit")
+    elif args.profile != None or args.profile_collapsed != None:
+        from mrcl_profiler import Profiler
+        symbols = None
+        if args.symbols != None:
+            symbols = json.loads(file_read(args.symbols))
+
+        profiler = Profiler(vm, symbols)
+        state = profiler.run(args.max_steps)
+        print(json.dumps(state))
+
+        if args.profile != None:
+            profiler.write_report(args.profile)
+        if args.profile_collapsed != None:
+            profiler.write_collapsed_stacks(args.profile_collapsed)
+    elif args.checkpoint != None:
+        import mrcl_checkpoint
+        state = mrcl_checkpoint.run_with_checkpoints(
+            vm, args.checkpoint, args.checkpoint_every, args.max_steps
+        )
+        print(json.dumps(state))
+    else:
+        state = vm.run(args.max_steps)
+        print(json.dumps(state))
@@ -4,10 +4,7 @@ asm_file=z_game_of_life.asm
 exe_file=z_game_of_life.exe.txt
 
 # compile
-cat test_common/compile/27.mrcl \
-  | python3 mrcl_lexer.py \
-  | python3 mrcl_parser.py \
-  | python3 mrcl_codegen.py \
+python3 mrcl_compiler.py --emit asm test_common/compile/27.mrcl \
   > $asm_file
 
 # assemble
@@ -15,7 +12,7 @@ cat $asm_file | python3 mrcl_asm.py \
   > $exe_file
 
 # run on VM
-python3 mrcl_vm.py $exe_file
+python3 mrcl_vm.py --interactive $exe_file
 
 # or to run step by step
-# STEP= python3 mrcl_vm.py $exe_file
+# STEP= python3 mrcl_vm.py --interactive $exe_file
@@ -0,0 +1,297 @@
+import argparse
+import difflib
+import glob
+import itertools
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import mrcl_lexer
+import mrcl_parser
+import mrcl_codegen
+import mrcl_compiler
+import mrcl_incremental
+import mrcl_exe
+import mrcl_batch
+import test_json
+
+# Test runner for the cases in test_common.
+#
+#   python3 test/run_tests.py all
+#   python3 test/run_tests.py compile 3
+#
+# Same cases and comparisons as the former Ruby (diff.rb) loop
+# in test.sh, but the stages run in-process and the cases run in
+# parallel on a process pool.
+#
+# run: the programs in test/run are compiled with every combination of
+# the compiler options and with the incremental compiler, and run on
+# both engines; the final VRAM must be the same as with the plain
+# compiler on the interpreter. Each build must also survive a round trip
+# through the binary executable format.
+
+TEST_COMMON_DIR = os.path.join(PROJECT_DIR, "test_common")
+RUN_DIR = os.path.join(PROJECT_DIR, "test", "run")
+
+MAX_ID_JSON = 8
+MAX_ID_LEX = 4
+MAX_ID_PARSE = 2
+MAX_ID_COMPILE = 27
+
+TASKS = ["json", "lex", "parse", "compile", "run"]
+
+RUN_OPTIONS = ["fold", "reg_b_leaf", "peephole", "inline_vram"]
+RUN_ENGINES = ["interp", "jit"]
+RUN_MAX_STEPS = 1000000
+
+# --------------------------------
+# normalization (same as the modes of diff.rb)
+
+def format_text(text):
+    return text
+
+def format_json(text):
+    return json.dumps(json.loads(text), indent=2) + "\n"
+
+def format_asm(text):
+    lines = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        lines.append(line + "\n")
+    return "".join(lines)
+
+# --------------------------------
+# stages
+
+# test/test_json.py: the file is read, parsed and printed again
+def run_test_json(path):
+    return test_json.to_json(test_json.parse_json(test_json.read_file(path))) + "\n"
+
+def run_lex(path):
+    tokens = mrcl_lexer.tokenize(read_file(path))
+    return "".join(mrcl_lexer.to_json(token) + "\n" for token in tokens)
+
+def run_parse(path):
+    tree = mrcl_parser.parse(mrcl_lexer.iter_tokens(read_file(path)))
+    return json.dumps(tree, indent=2) + "\n"
+
+def run_codegen(path):
+    tree = mrcl_parser.parse(mrcl_lexer.iter_tokens(read_file(path)))
+    return mrcl_codegen.codegen_to_str(tree).replace("'", '"')
+
+# => [(build name, insns), ...]
+def build_program(src):
+    builds = []
+    for values in itertools.product([False, True], repeat=len(RUN_OPTIONS)):
+        options = dict(zip(RUN_OPTIONS, values))
+        name = " ".join(name for name in RUN_OPTIONS if options[name])
+        builds.append((name, mrcl_compiler.compile_source(src, **options)))
+
+    for peephole in [False, True]:
+        compiler = mrcl_incremental.IncrementalCompiler(peephole=peephole)
+        insns, _ = compiler.compile(src)
+        builds.append(("incremental" + (" peephole" if peephole else ""), insns))
+
+    return builds
+
+# => final VRAM
+def run_program(insns, engine):
+    vm = mrcl_batch.create_vm(engine)
+    vm.load_program(insns)
+    status, state = mrcl_batch.run_vm(vm, RUN_MAX_STEPS, None)
+    if status != "exited":
+        raise Exception(f"not exited ({status})")
+    return state["vram"]
+
+def format_vram(vram):
+    return "".join(f"{i}: {v}\n" for i, v in enumerate(vram))
+
+# --------------------------------
+# cases
+
+# => (input file, expected file, function, formatter)
+def get_case(task, nn):
+    if task == "json":
+        path = os.path.join(TEST_COMMON_DIR, "json", f"{nn}.json")
+        return (path, path, run_test_json, format_json)
+    elif task == "lex":
+        dir_ = os.path.join(TEST_COMMON_DIR, "lex")
+        return (
+            os.path.join(dir_, f"{nn}.mrcl"),
+            os.path.join(dir_, f"exp_{nn}.txt"),
+            run_lex, format_text
+        )
+    elif task == "parse":
+        dir_ = os.path.join(TEST_COMMON_DIR, "parse")
+        return (
+            os.path.join(dir_, f"{nn}.mrcl"),
+            os.path.join(dir_, f"exp_{nn}.vgt.json"),
+            run_parse, format_json
+        )
+    elif task == "compile":
+        dir_ = os.path.join(TEST_COMMON_DIR, "compile")
+        return (
+            os.path.join(dir_, f"{nn}.mrcl"),
+            os.path.join(dir_, f"exp_{nn}.vga.txt"),
+            run_codegen, format_asm
+        )
+    else:
+        raise Exception(f"invalid task ({task})")
+
+def read_file(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def diff_texts(exp, act, exp_name, act_name):
+    diff = difflib.unified_diff(
+        exp.splitlines(True), act.splitlines(True),
+        fromfile=exp_name, tofile=act_name
+    )
+    return "".join(diff)
+
+# => error or None
+def run_program_case(nn):
+    path = os.path.join(RUN_DIR, f"{nn}.mrcl")
+    src = read_file(path)
+
+    builds = build_program(src)
+
+    # the first build is the plain compiler
+    _, exp_insns = builds[0]
+    exp = format_vram(run_program(exp_insns, "interp"))
+
+    errs = []
+    for name, insns in builds:
+        # the binary executable must load back the same instructions
+        if mrcl_exe.loads(mrcl_exe.dump(insns)) != insns:
+            errs.append(f"binary executable round trip differs ({name or 'plain'})\n")
+
+        for engine in RUN_ENGINES:
+            act = format_vram(run_program(insns, engine))
+            if act != exp:
+                act_name = " ".join([engine, name]).strip()
+                errs.append(diff_texts(exp, act, path, f"({act_name})"))
+
+    if len(errs) == 0:
+        return None
+    return "".join(errs)
+
+# => (task, nn, error or None)
+def run_case(task, nn):
+    if task == "run":
+        try:
+            return (task, nn, run_program_case(nn))
+        except Exception:
+            return (task, nn, traceback.format_exc())
+
+    in_file, exp_file, fn, fmt = get_case(task, nn)
+
+    try:
+        exp = fmt(read_file(exp_file))
+        act = fmt(fn(in_file))
+    except OSError as e:
+        return (task, nn, f"missing file ({e.filename})")
+    except Exception:
+        return (task, nn, traceback.format_exc())
+
+    if act == exp:
+        return (task, nn, None)
+    return (task, nn, diff_texts(exp, act, exp_file, "(actual)"))
+
+def get_ids(task, ids):
+    if len(ids) > 0:
+        return ids
+
+    max_id = {
+        "json": MAX_ID_JSON,
+        "lex": MAX_ID_LEX,
+        "parse": MAX_ID_PARSE,
+        "compile": MAX_ID_COMPILE,
+        "run": len(glob.glob(os.path.join(RUN_DIR, "*.mrcl"))),
+    }[task]
+    return list(range(1, max_id + 1))
+
+def run_cases(cases, workers):
+    if workers == 1:
+        return [run_case(task, nn) for task, nn in cases]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            run_case,
+            [task for task, _ in cases],
+            [nn for _, nn in cases],
+            chunksize=1
+        ))
+
+# --------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("task", choices=TASKS + ["all"])
+    parser.add_argument("ids", type=int, nargs="*", help="case ids (default: all)")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None,
+        help="number of worker processes (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--no-test-common", action="store_true",
+        help="skip the tasks that need test_common (all: run only test/run)"
+    )
+    args = parser.parse_args()
+
+    if args.no_test_common and args.task not in ["run", "all"]:
+        parser.error(f"{args.task} needs test_common")
+
+    return args
+
+def main():
+    args = parse_args()
+
+    if args.no_test_common:
+        # test/run does not need test_common
+        tasks = ["run"]
+    elif args.task == "all":
+        tasks = TASKS
+    else:
+        tasks = [args.task]
+
+    if not os.path.isdir(TEST_COMMON_DIR) and tasks != ["run"]:
+        print(
+            f"test cases not found: {TEST_COMMON_DIR}\n"
+            "  (git submodule update --init, or --no-test-common)",
+            file=sys.stderr
+        )
+        sys.exit(1)
+
+    cases = []
+    for task in tasks:
+        for id_ in get_ids(task, args.ids):
+            cases.append((task, "%02d" % id_))
+
+    errs = []
+    for task, nn, err in run_cases(cases, args.workers):
+        if err == None:
+            print(f"{task} {nn}: ok")
+        else:
+            print(f"{task} {nn}: NG")
+            print(err, file=sys.stderr)
+            errs.append(f"{task}_{nn}")
+
+    if len(errs) == 0:
+        print(f"{args.task}: ok")
+    else:
+        print("----")
+        print("FAILED:")
+        for err in errs:
+            print(f"  {err}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,11 @@ def to_json(data):
 def parse_json(json_):
     return json.loads(json_)
 
-in_file = sys.argv[1]
-json_str = read_file(in_file)
+def main():
+    in_file = sys.argv[1]
+    json_str = read_file(in_file)
 
-print(to_json(parse_json(json_str)))
+    print(to_json(parse_json(json_str)))
+
+if __name__ == "__main__":
+    main()